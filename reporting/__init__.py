@@ -1,39 +1,22 @@
-import imp
-from base import Report
+from base import Report, DistinctCount
+from reporting.site import site
 
 
-
-_registry = {}
-
-def register(slug, klass):
-    _registry[slug] = klass
+def register(slug, klass, verbose_name=None):
+    "Registers a Report subclass, or the dotted path of one, see reporting.site"
+    site.register(slug, klass, verbose_name)
 
 def get_report(slug):
-    try:
-        return _registry[slug]
-    except KeyError:
-        raise Exception("No such report '%s'" % slug)
+    return site.get_report(slug)
+
+def get_entries():
+    return site.entries()
 
 def all_reports():
-    return _registry.items()
+    return site.all_reports()
 
+def load_all():
+    site.load_all()
 
 def autodiscover():
-    from django.conf import settings
-    REPORTING_SOURCE_FILE =  getattr(settings, 'REPORTING_SOURCE_FILE', 'reports') 
-    for app in settings.INSTALLED_APPS:
-        try:
-            app_path = __import__(app, {}, {}, [app.split('.')[-1]]).__path__
-        except AttributeError:
-            continue
-
-        try:
-            imp.find_module(REPORTING_SOURCE_FILE, app_path)
-        except ImportError:
-            continue
-        __import__('%s.%s' % (app, REPORTING_SOURCE_FILE))
-
-
-def DistinctCount(field):
-    from django.db.models import Count
-    return Count(field, distinct=True)
+    site.autodiscover()
@@ -0,0 +1,100 @@
+"""
+Estimates for reports with ``approximate = True``: annotations computed over
+a deterministic sample of rows and scaled up, and HyperLogLog sketches for
+DistinctCount columns. Building the sketches reads all the filtered rows, so
+reports only use them when they are cached; without a cache timeout distinct
+values are counted exactly by the database.
+"""
+import math
+
+from django.db.models import Sum, Count
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import md5_constructor
+
+
+class Estimate(object):
+    "An approximate value and its standard error, None if unknown"
+    def __init__(self, value, error=None):
+        self.value = value
+        self.error = error
+
+    def __cmp__(self, other):
+        return cmp(self.value, getattr(other, 'value', other))
+
+    def __float__(self):
+        return float(self.value)
+
+    def __unicode__(self):
+        if self.error is None:
+            return u'~%s' % self.value
+        return u'%s \xb1 %s' % (self.value, int(round(self.error)))
+
+    def __str__(self):
+        return smart_str(unicode(self))
+
+
+def estimate(func, value, rows, every):
+    """
+    Estimate of annotation ``func`` of a group from its ``value`` over the
+    ``rows`` sampled one in ``every``. Sum and Count are scaled up with a
+    relative error of 1 / sqrt(rows), other values are kept as they are
+    """
+    if value is None:
+        return None
+    if func not in (Sum, Count):
+        return Estimate(value)
+    error = None
+    if rows:
+        error = abs(float(value)) * every / math.sqrt(rows)
+    return Estimate(value * every, error)
+
+
+class HyperLogLog(object):
+    """
+    Distinct count sketch with 2 ** precision one byte registers, standard
+    error 1.04 / sqrt(2 ** precision). Sketches of disjoint or overlapping
+    sets can be merged into a sketch of their union
+    """
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        hashed = int(md5_constructor(smart_str(value)).hexdigest()[:16], 16)
+        bits = 64 - self.precision
+        index = hashed >> bits
+        rank = bits - (hashed & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        "Adds the values of ``other`` to this sketch"
+        if other.precision != self.precision:
+            raise ValueError("Can not merge sketches of different precision")
+        for index, rank in enumerate(other.registers):
+            if rank > self.registers[index]:
+                self.registers[index] = rank
+        return self
+
+    def count(self):
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        result = alpha * size * size / sum([2.0 ** -rank for rank in self.registers])
+        zeros = self.registers.count(chr(0))
+        if result <= 2.5 * size and zeros:
+            result = size * math.log(float(size) / zeros)
+        return int(round(result))
+
+    def estimate(self):
+        count = self.count()
+        return Estimate(count, count * 1.04 / math.sqrt(len(self.registers)))
+
+
+def merge_all(sketches):
+    "A new sketch of the union of ``sketches``, None if there are none"
+    result = None
+    for sketch in sketches:
+        if result is None:
+            result = HyperLogLog(sketch.precision)
+        result.merge(sketch)
+    return result
@@ -1,48 +1,181 @@
 from django.contrib.admin.options import IncorrectLookupParameters
 from django.utils.http import urlencode
 from django.utils.encoding import smart_str
+from django.conf import settings
 from django.db import models
+from django.db.models import Q, Sum, Count, Min, Max, Avg
+from django.db.models.sql.constants import LOOKUP_SEP, QUERY_TERMS
+from django.core.exceptions import ValidationError, ImproperlyConfigured
 from django.db.models.fields.related import RelatedField
 from django.db.models.fields import FieldDoesNotExist
 from django.utils.text import capfirst
 from django.utils.html import escape
 from django.utils.safestring import mark_safe
 from django.core.urlresolvers import reverse
+from collections import namedtuple
 
 from filterspecs import *
+import cache
+import parallel
+import profiling
+import signals
+import timeseries
+from timeseries import rollup
+import db
+import guards
+from approximate import estimate, merge_all, HyperLogLog
+from results import ResultSet
 
 
 def get_model_field(model, name):
     return model._meta.get_field(name)
 
-def get_lookup_value(model, original, lookup):
+def get_lookup_field(model, lookup):
+    """
+    Follows ``lookup`` through related fields and returns the field it ends on
+    """
     parts = lookup.split('__')
+    field = get_model_field(model, parts[0])
+    if len(parts) == 1 or not isinstance(field, RelatedField):
+        return field
+    return get_lookup_field(field.rel.to, '__'.join(parts[1:]))
+
+def validate_lookup(model, lookup):
+    "Raises IncorrectLookupParameters unless ``lookup`` can be passed to filter()"
+    parts = lookup.split(LOOKUP_SEP)
+    if len(parts) > 1 and parts[-1] in QUERY_TERMS:
+        parts = parts[:-1]
+    for ind, part in enumerate(parts):
+        try:
+            field, _, direct, m2m = model._meta.get_field_by_name(part)
+        except FieldDoesNotExist:
+            raise IncorrectLookupParameters("Cannot resolve '%s' in lookup '%s'" % (part, lookup))
+        if not direct:
+            model = field.model
+        elif isinstance(field, RelatedField):
+            model = field.rel.to
+        elif ind != len(parts) - 1:
+            raise IncorrectLookupParameters("'%s' in lookup '%s' is not a relation" % (part, lookup))
+
+def get_lookup_models(model, lookup):
+    "Returns models reached through related fields of ``lookup``"
+    parts = lookup.split('__')
+    field = get_model_field(model, parts[0])
+    if not isinstance(field, RelatedField):
+        return []
+    rel_model = field.rel.to
+    if len(parts) == 1:
+        return [rel_model]
+    return [rel_model] + get_lookup_models(rel_model, '__'.join(parts[1:]))
+
+def get_lookup_values(model, originals, lookup, using=None):
+    """
+    Resolves labels for all ``originals`` of ``lookup`` at once, issuing
+    a single pk__in query for the related model on database ``using``.
+    Returns {original: label}
+    """
     try:
-        field = get_model_field(model, parts[0])
+        field = get_lookup_field(model, lookup)
+    except FieldDoesNotExist:
+        field = None
+    if not isinstance(field, RelatedField):
+        return dict((v, v) for v in originals)
+    return get_related_labels(field.rel.to, originals, using)
+
+def get_related_labels(rel_model, originals, using=None):
+    "Labels of ``originals`` being primary keys of ``rel_model``"
+    keys = set([v for v in originals if v is not None])
+    objects = db.route(rel_model.objects.all(), using).in_bulk(list(keys))
+    labels = {}
+    for v in originals:
+        if v in objects:
+            labels[v] = unicode(objects[v])
+        else:
+            labels[v] = v
+    return labels
+
+def get_lookup_value(model, original, lookup):
+    return get_lookup_values(model, [original], lookup)[original]
+
+def lookup_value(instance, lookup):
+    """
+    Value of ``lookup`` for a model instance, as values() would return it.
+    Only lookups following forward foreign keys are supported, ValueError is
+    raised for others
+    """
+    obj = instance
+    parts = lookup.split('__')
+    for ind, part in enumerate(parts):
+        try:
+            field = get_model_field(obj, part)
+        except FieldDoesNotExist:
+            raise ValueError("Cannot follow '%s' of '%s'" % (part, lookup))
+        if isinstance(field, models.ManyToManyField):
+            raise ValueError("Cannot follow '%s' of '%s'" % (part, lookup))
+        if ind == len(parts) - 1:
+            return getattr(obj, field.attname)
         if not isinstance(field, RelatedField):
-            return original
-        rel_model = field.rel.to
-        if len(parts) == 1:
-            return unicode(rel_model.objects.get(pk=original))
-        next_lookup = '__'.join(parts[1:])
-        return get_lookup_value(rel_model, original, next_lookup)
-    except:
-        return original
+            raise ValueError("Cannot follow '%s' of '%s'" % (part, lookup))
+        obj = getattr(obj, part)
+        if obj is None:
+            return None
     
 
 
+def DistinctCount(field):
+    return Count(field, distinct=True)
+
+def in_lookup(lookup, values):
+    "Q matching ``values`` of ``lookup``, None included"
+    condition = Q(**{'%s__in' % lookup: [v for v in values if v is not None]})
+    if None in values:
+        condition |= Q(**{'%s__isnull' % lookup: True})
+    return condition
+
+def is_single_valued(model, lookup):
+    "True if ``lookup`` only follows forward foreign keys"
+    for part in lookup.split('__'):
+        try:
+            field = get_model_field(model, part)
+        except FieldDoesNotExist:
+            return False
+        if isinstance(field, models.ManyToManyField):
+            return False
+        if not isinstance(field, RelatedField):
+            return True
+        model = field.rel.to
+    return True
+
+def lookup_title(report, lookup):
+    "Column title of ``lookup`` of ``report``, a Report class or instance"
+    try:
+        return capfirst(get_model_field(report.model, lookup).verbose_name)
+    except FieldDoesNotExist:
+        if '__' not in lookup and not hasattr(report, lookup):
+            raise
+        parts = lookup.split('__')
+        return ', '.join([capfirst(i.replace('_', ' ')) for i in parts])
+
 class ModelAdminMock(object):
-    def __init__(self, model):
+    def __init__(self, model, using=None):
         self.model = model
+        self.using = using
         
     def queryset(self, request):
-        return self.model.objects.all()
+        return db.route(self.model.objects.all(), self.using)
     
 
 GROUP_BY_VAR = 'gruop_by_'
 SORT_VAR = 's'
 SORTTYPE_VAR = 'st'
 DETAILS_SWITCH_VAR = 'ds'
+PAGE_VAR = 'p'
+LIMIT_VAR = 'l'
+EXACT_VAR = 'ex'
+CONTROL_VARS = [GROUP_BY_VAR, SORT_VAR, SORTTYPE_VAR, DETAILS_SWITCH_VAR,
+                PAGE_VAR, LIMIT_VAR, EXACT_VAR, SHOW_ALL_CHOICES_VAR]
+
+SAMPLE_ROWS = 'reporting_sample_rows'
 
 
 class Header(object):
@@ -54,86 +187,619 @@ class Header(object):
         if ind == report.sort_by:
             order_type = {'asc':'desc', 'desc': 'asc'}[report.sort_type]
             self.css_class = 'sorted %sending' % report.sort_type
-        self.url = report.get_query_string({SORT_VAR: ind, SORTTYPE_VAR: order_type})
+        self.url = report.get_query_string({SORT_VAR: ind, SORTTYPE_VAR: order_type,
+                                            PAGE_VAR: None})
+
+Lookup = namedtuple('Lookup', 'field related_model models single_valued title')
+
+def resolve_lookup(report, lookup):
+    """
+    Resolves ``lookup`` of ``report`` to the model field it names (None for
+    lookups spanning relations or report attributes), the related model it
+    ends on, the models it goes through and its title
+    """
+    model = report.model
+    try:
+        field = get_model_field(model, lookup)
+    except FieldDoesNotExist:
+        field = None
+    try:
+        target = get_lookup_field(model, lookup)
+        rel_models = tuple(get_lookup_models(model, lookup))
+    except FieldDoesNotExist:
+        target, rel_models = None, ()
+    related_model = None
+    if isinstance(target, RelatedField):
+        related_model = target.rel.to
+    try:
+        title = lookup_title(report, lookup)
+    except FieldDoesNotExist:
+        title = None
+    return Lookup(field, related_model, rel_models, is_single_valued(model, lookup), title)
+
+
+class ReportSpec(object):
+    """
+    The request independent parts of a report class, compiled once by
+    reporting.register: annotations, aggregates and group by fields split
+    from their titles and every lookup they use resolved. Read only
+    """
+    def __init__(self, klass):
+        lookups = {}
+        names = [item[0] for item in klass.annotate]
+        names += [item[0] for item in klass.aggregate or []]
+        names += [self.item_name(item) for item in klass.group_by]
+        for name in names:
+            try:
+                validate_lookup(klass.model, name)
+            except IncorrectLookupParameters, e:
+                raise ImproperlyConfigured('%s: %s' % (klass.__name__, e))
+        names += list(klass.list_filter or []) + list(klass.detail_list_display or [])
+        if klass.date_hierarchy:
+            names.append(klass.date_hierarchy)
+        for name in names:
+            if name not in lookups:
+                lookups[name] = resolve_lookup(klass, name)
+        
+        self.__dict__['lookups'] = lookups
+        data = {}
+        data['annotate'], data['annotate_titles'] = self.split_annotate_titles(klass, klass.annotate)
+        data['aggregate'], data['aggregate_titles'] = None, ()
+        if klass.aggregate is not None:
+            data['aggregate'], data['aggregate_titles'] = self.split_annotate_titles(klass, klass.aggregate)
+        data['group_by'], data['group_by_titles'] = self.split_titles(klass, klass.group_by)
+        cache_models = [klass.model]
+        for name in data['group_by']:
+            for model in lookups[name].models:
+                if model not in cache_models:
+                    cache_models.append(model)
+        data['cache_models'] = tuple(cache_models)
+        self.__dict__.update(data)
+    
+    def __setattr__(self, name, value):
+        raise AttributeError("ReportSpec is read only")
+    
+    def item_name(self, item):
+        if isinstance(item, (list, tuple)):
+            return item[0]
+        return item
+    
+    def title(self, klass, lookup):
+        return self.lookups[lookup].title or lookup_title(klass, lookup)
+    
+    def split_annotate_titles(self, klass, items):
+        data, titles = [], []
+        for item in items:
+            if len(item) == 3:
+                data.append(tuple(item[:2]))
+                titles.append(item[-1])
+            else:
+                data.append(tuple(item))
+                text = '%s %s' % (self.title(klass, item[0]), item[1].__name__)
+                titles.append(text)
+        return tuple(data), tuple(titles)
+    
+    def split_titles(self, klass, items):
+        data, titles = [], {}
+        for item in items:
+            if not isinstance(item, (list, tuple)):
+                data.append(item)
+                titles[item] = self.title(klass, item)
+            else:
+                assert len(item) == 2
+                data.append(item[0])
+                titles[item[0]] = item[1]
+        return tuple(data), titles
+
 
 class Report(object):
     list_filter = None
     detail_list_display = None
+    details_limit = None
     date_hierarchy = None
     aggregate = None
+    list_per_page = None
+    slug = None
+    cache_timeout = None
+    cache_invalidation = False
+    materialize = False
+    materialize_filters = None
+    materialize_changed_field = None
+    materialize_incremental = False
+    background = False
+    parallel_queries = None
+    stream = False
+    approximate = False
+    sample_every = 100
+    allowed_lookups = None
+    max_in_values = None
+    statement_timeout = None
+    max_query_cost = None
+    using = None
+    replica_max_lag = None
     
-    def __init__(self, request):
+    def __init__(self, request, load=True):
         self.request = request
-        admin_mock = ModelAdminMock(self.model)
-        
-        self.annotate, self.annotate_titles = self.split_annotate_titles(self.annotate)
-        self.aggregate, self.aggregate_titles = self.split_annotate_titles(self.aggregate)
-        self.group_by, self.group_by_titles = self.split_titles(self.group_by)
+        self.profile = getattr(settings, 'REPORTING_PROFILE', settings.DEBUG)
+        self.stages = []
+        self.spec = self.get_spec()
+        self.annotate, self.annotate_titles = self.spec.annotate, self.spec.annotate_titles
+        self.aggregate, self.aggregate_titles = self.spec.aggregate, self.spec.aggregate_titles
+        self.group_by, self.group_by_titles = self.spec.group_by, self.spec.group_by_titles
         if self.detail_list_display and not hasattr(self, 'detail_link_fields'):
             self.detail_link_fields = [self.detail_list_display[0]]
         
         self.params = dict(self.request.GET.items())
-        self.selected_group_by = self.get_group_by_field()
-        self.sort_by = int(self.params.get(SORT_VAR, '0'))
+        self.database = db.choose_database(self)
+        self.group_by_levels = self.get_group_by_levels()
+        self.selected_group_by = self.group_by_levels[0]
+        self.nested = len(self.group_by_levels) > 1
+        self.sort_by = self.get_int_param(SORT_VAR, 0, len(self.annotate))
         self.show_details = self.params.get(DETAILS_SWITCH_VAR) is not None
         self.sort_type = self.params.get(SORTTYPE_VAR, 'asc')
-        self.filter_specs, self.has_filters = self.get_filters(admin_mock)
-        self.get_results()
+        if self.sort_type not in ('asc', 'desc'):
+            raise IncorrectLookupParameters("Invalid sort type '%s'" % self.sort_type)
+        self.page_num = self.get_int_param(PAGE_VAR, 0)
+        self.list_per_page = self.get_int_param(LIMIT_VAR, self.list_per_page or 0) or None
+        self.approximate = self.approximate and EXACT_VAR not in self.params
+        self.bucket = self.get_bucket_kind(self.selected_group_by)
+        if self.bucket:
+            timeseries.check_kind(self, self.bucket)
+            self.show_details = False
+        if self.nested or self.stream or self.bucket:
+            self.list_per_page = None
+        self.lookup_params = self.get_lookup_params()
+        self._queryset = None
         self.query_set = self.get_queryset()
-        self.get_aggregation()
+        self.derived_aggregation = None
+        self._aggregation = None
+        self._date_hierarchy = None
+        self._filter_specs = None
+        self.guarded = False
+        if load:
+            self.load()
         
     
-    def get_results(self):
-        qs = self.get_queryset()
+    def load(self):
+        """
+        Runs the queries of the report page. Views run it through
+        guards.limited, reports built internally are not guarded
+        """
+        if self.get_parallel_queries() > 1:
+            self.load_parallel()
+        else:
+            self.load_results()
+            self.get_aggregation()
+    
+    def get_parallel_queries(self):
+        if self.parallel_queries is not None:
+            return self.parallel_queries
+        return getattr(settings, 'REPORTING_PARALLEL_QUERIES', 1)
+    
+    def load_parallel(self):
+        """
+        Runs the independent queries of a report page concurrently: results,
+        aggregation (unless it can be derived from the results), filters and
+        the date hierarchy
+        """
+        model_admin = ModelAdminMock(self.model, self.database)
+        tasks = [('results', self.load_results)]
+        if self.aggregate is not None and not self.derives_aggregation():
+            tasks.append(('aggregation', self.get_aggregation))
+        for ind, field_name in enumerate(self.list_filter or []):
+            tasks.append((ind, lambda f=field_name: self.get_filter(f, model_admin)))
+        if self.date_hierarchy:
+            tasks.append(('date_hierarchy', self.get_date_hierarchy))
+        if self.guarded:
+            # every thread has its own connection to limit
+            tasks = [(name, lambda func=func: guards.limited(self, func)) for name, func in tasks]
+        done = parallel.run(tasks, self.get_parallel_queries())
+        self._filter_specs = []
+        for ind in range(len(self.list_filter or [])):
+            if done[ind] is not None:
+                self._filter_specs.append(done[ind])
+        self.get_aggregation()
+    
+    def filter_specs(self):
+        "Built on first use, reports that are not rendered (exports) skip their queries"
+        if self._filter_specs is None:
+            self._filter_specs = self.get_filters(ModelAdminMock(self.model, self.database))[0]
+        return self._filter_specs
+    filter_specs = property(filter_specs)
+    
+    def has_filters(self):
+        return bool(self.filter_specs)
+    has_filters = property(has_filters)
+    
+    def get_date_hierarchy(self):
+        if self._date_hierarchy is None:
+            from reporting.templatetags.reporting import date_hierarchy_choices
+            compute = lambda: date_hierarchy_choices(self)
+            self._date_hierarchy = self.timed('date_hierarchy',
+                lambda: self.get_cached('date_hierarchy', compute))
+        return self._date_hierarchy
         
+    
+    def load_results(self):
+        def compute():
+            self.get_results()
+            return self.results, self.result_count
+        self.results, self.result_count = self.timed('results',
+            lambda: self.get_cached('results', compute), lambda r: len(r[0]))
+    
+    def timed(self, name, func, rows=None):
+        """
+        Calls ``func`` recording wall time, query count and row count (from
+        ``rows(result)``) as report stage ``name``, if profiling is on
+        """
+        if not self.profile:
+            return func()
+        return profiling.record(self.stages, name, func, rows,
+                                db.get_connection(self.database))
+    
+    def publish_stages(self):
+        "Sends the recorded stages to the log and the report_profiled signal"
+        if not self.profile:
+            return
+        profiling.logger.info('Report %s stages' % self.get_slug(),
+                              extra={'report': self.get_slug(), 'stages': self.stages})
+        signals.report_profiled.send(sender=self.__class__, report=self, stages=self.stages)
+    
+    def profile_footer(self):
+        return self.profile and getattr(settings, 'REPORTING_PROFILE_FOOTER', settings.DEBUG)
+    
+    def get_cache_timeout(self):
+        if self.cache_timeout is not None:
+            return self.cache_timeout
+        return getattr(settings, 'REPORTING_CACHE_TIMEOUT', 0)
+    
+    def get_cached(self, name, compute):
+        """
+        Returns value ``name`` for the current params from the reporting
+        cache, calling ``compute`` on a miss. Does nothing unless a cache
+        timeout is set
+        """
+        timeout = self.get_cache_timeout()
+        if not timeout:
+            return compute()
+        backend = cache.get_backend()
+        key = cache.make_key(self.get_slug(), self.params, self.selected_group_by, name)
+        hit = backend.get(key)
+        if hit is None:
+            hit = (compute(),)
+            backend.set(key, hit, timeout)
+        return hit[0]
+    
+    def get_state(self):
+        "Computed results, reusable by another instance with the same params"
+        return self.results, self.result_count, self.get_aggregation()
+    
+    def set_state(self, state):
+        self.results, self.result_count, self._aggregation = state
+    
+    def get_job_id(self):
+        key = cache.make_key(self.get_slug(), self.params, self.selected_group_by, 'job')
+        return key.split(':')[-1]
+    
+    def get_slug(self):
+        "The slug of this very class, subclasses of a registered report get their own"
+        return (self.__class__.__dict__.get('slug')
+                or '%s.%s' % (self.__module__, self.__class__.__name__))
+    
+    def get_spec(cls):
+        "The ReportSpec of the class, compiled on first use"
+        spec = cls.__dict__.get('_spec')
+        if spec is None:
+            spec = ReportSpec(cls)
+            cls._spec = spec
+        return spec
+    get_spec = classmethod(get_spec)
+    
+    def get_cache_models(cls):
+        "Models whose changes invalidate the cached report"
+        return list(cls.get_spec().cache_models)
+    get_cache_models = classmethod(get_cache_models)
+    
+    def get_annotated_queryset(self, fields=None):
+        "Group by values with annotations, one row per group"
         annotate_args = {}
         for field, func in self.annotate:
             annotate_args[field] = func(field)
-        
+        fields = fields or [self.selected_group_by]
+        return self.get_queryset().values(*fields).annotate(**annotate_args)
+    
+    def get_results(self):
+        if self.nested:
+            return self.get_nested_results()
+        if self.bucket:
+            return self.get_time_series_results()
+        if self.approximate:
+            return self.get_approximate_results()
         values = [self.selected_group_by]
         
-        rows = qs.values(*values).annotate(**annotate_args).order_by(values[0])
+        ordering = self.get_ordering()
+        snapshot, data = self.get_snapshot(), None
+        if snapshot is not None:
+            rows, data = snapshot
+        else:
+            rows = self.get_annotated_queryset()
+        rows = rows.order_by(*(ordering or values))
+        self.result_count = None
+        if self.list_per_page:
+            self.result_count = rows.count()
+            if ordering is not None:
+                rows = rows[self.get_window()]
+        rows = list(rows)
+        if snapshot is None and (not self.list_per_page or ordering is None):
+            data = self.derive_aggregation(rows)
+        if self.aggregate is not None and data is not None:
+            self.derived_aggregation = self.format_aggregation(data)
+        labels = self.get_labels([row[self.selected_group_by] for row in rows],
+                                 self.selected_group_by)
         
-        self.results = []
+        self.results = ResultSet(len(self.annotate))
         for row in rows:
-            row_vals = [self.get_value(row, self.selected_group_by)]
-            for field, func in self.annotate:
-                row_vals.append(row[field])
-            details = None
-            if self.detail_list_display and self.show_details:
-                details = self.get_details(row)
-            self.results.append({'values': row_vals, 
-                                 'details': details})
+            self.results.append(row[self.selected_group_by],
+                                self.get_value(row, self.selected_group_by, labels),
+                                [row[field] for field, func in self.annotate])
+        
+        if ordering is None:
+            self.sort_results()
+            if self.list_per_page:
+                self.results = self.results[self.get_window()]
         
-        self.sort_results()
+        if self.detail_list_display and self.show_details:
+            keys = None
+            if self.list_per_page:
+                keys = self.results.keys
+            all_details = self.timed('details', lambda: self.get_all_details(keys),
+                lambda d: sum([len(rows) for rows in d.values()]))
+            self.results.details = [all_details.get(key, []) for key in self.results.keys]
+            self.results.details_more = [self.details_skipped.get(key)
+                                         for key in self.results.keys]
     
-    def sort_results(self):
+    def get_nested_results(self):
+        """
+        Fetches all group by levels with one query and builds the group tree
+        in a single pass over the rows sorted by level. Every group gets a
+        subtotal row before its children, subtotals are only computed for
+        Sum, Count, Min and Max. Rows carry their ``depth`` and the css
+        classes of their ancestors in ``parents``
+        """
+        levels = self.group_by_levels
+        rows = list(self.get_annotated_queryset(levels).order_by(*levels))
+        labels = [self.get_labels([row[f] for row in rows], f) for f in levels]
+        self.result_count = None
+        self.results = ResultSet(len(self.annotate))
+        for name in ('depth', 'parents', 'id'):
+            self.results.add_column(name)
+        groups = self.results.add_column('group')
+        columns = self.results.columns
+        stack = []
+        for row in rows:
+            depth = 0
+            while depth < len(stack) and self.results.keys[stack[depth]] == row[levels[depth]]:
+                depth += 1
+            del stack[depth:]
+            for level in range(depth, len(levels) - 1):
+                node = self.append_tree_row(row, level, labels[level], stack)
+                groups[node] = True
+                stack.append(node)
+            leaf = self.append_tree_row(row, len(levels) - 1, labels[-1], stack)
+            for ind, (field, func) in enumerate(self.annotate):
+                columns[ind][leaf] = row[field]
+                for node in stack:
+                    columns[ind][node] = rollup(func, columns[ind][node], row[field])
+    
+    def append_tree_row(self, row, level, labels, stack):
+        "Appends a row of the group tree, returns its index"
+        key = row[self.group_by_levels[level]]
+        index = self.results.append(key, labels.get(key, key), [None] * len(self.annotate))
+        self.results.extra['id'][index] = index
+        self.results.extra['depth'][index] = level
+        self.results.extra['group'][index] = False
+        self.results.extra['parents'][index] = ' '.join(['tree-child-%s' % node
+                                                         for node in stack])
+        return index
+    
+    def get_time_series_results(self):
+        """
+        One row per ``self.bucket`` of ``date_hierarchy`` from the first to
+        the last date, computed with one grouped query. See timeseries
+        """
+        self.result_count = None
+        self.results = ResultSet(len(self.annotate))
+        for date, row in timeseries.get_rows(self, self.bucket):
+            self.results.append(date, timeseries.label(date, self.bucket),
+                                [row[field] for field, func in self.annotate])
+        if self.sort_by:
+            self.results.sort(self.sort_by - 1, reverse=self.sort_type == 'desc')
+        elif self.sort_type == 'desc':
+            self.results = self.results[::-1]
+    
+    def get_sample_queryset(self):
+        """
+        Deterministic sample of the filtered queryset: rows whose (integer)
+        primary key is a multiple of ``sample_every``
+        """
+        qn = db.get_connection(self.database).ops.quote_name
+        opts = self.model._meta
+        column = '%s.%s' % (qn(opts.db_table), qn(opts.pk.column))
+        return self.get_queryset().extra(where=['%s %%%% %%s = 0' % column],
+                                         params=[self.sample_every])
+    
+    def get_sketches(self, field):
+        """
+        {group by value: HyperLogLog of distinct ``field`` values}. Building
+        them reads every distinct (group, value) pair of the unsampled rows,
+        so they are only used when they can be cached, see get_distinct_counts
+        """
+        def compute():
+            sketches = {}
+            qs = self.get_queryset().values_list(self.selected_group_by, field)
+            for group, value in qs.distinct().order_by().iterator():
+                if value is not None:
+                    sketches.setdefault(group, HyperLogLog()).add(value)
+            return sketches
+        return self.timed('sketch %s' % field,
+                          lambda: self.get_cached('sketches %s' % field, compute))
+    
+    def use_sketches(self):
+        return bool(self.get_cache_timeout())
+    
+    def get_distinct_counts(self, field):
+        """
+        {group by value: distinct count of ``field``} over all the filtered
+        rows. With a cache timeout they are estimated from sketches, which
+        the aggregation reuses; otherwise the database counts them exactly
+        with one grouped COUNT(DISTINCT) query. Either way every row is read
+        """
+        if self.use_sketches():
+            sketches = self.get_sketches(field)
+            return dict([(group, sketch.estimate()) for group, sketch in sketches.items()])
+        key = self.selected_group_by
+        qs = self.get_queryset().values(key).annotate(**{field: DistinctCount(field)})
+        return self.timed('distinct %s' % field,
+                          lambda: dict([(row[key], row[field]) for row in qs.order_by()]))
+    
+    def get_approximate_results(self):
         """
-        Sorting is performed manually since queries are with annotations
+        Annotations estimated from the rows of get_sample_queryset, see
+        approximate.estimate. DistinctCount columns are counted over all
+        rows instead, see get_distinct_counts. Only groups with sampled
+        rows are shown, sorting and pagination are done in memory
         """
-        def cmp(x,y):
-            if self.sort_type == 'asc':
-                val1 = x['values'][self.sort_by]
-                val2 = y['values'][self.sort_by]
+        key = self.selected_group_by
+        annotate_args = {SAMPLE_ROWS: Count('pk')}
+        distinct = {}
+        for field, func in self.annotate:
+            if func is DistinctCount:
+                distinct[field] = self.get_distinct_counts(field)
             else:
-                val1 = y['values'][self.sort_by]
-                val2 = x['values'][self.sort_by]
-            if val2 > val1:
-                return -1
-            elif val2 < val1:
-                return 1
-            return 0
-        self.results.sort(cmp)
+                annotate_args[field] = func(field)
+        qs = self.get_sample_queryset().values(key).annotate(**annotate_args)
+        rows = list(qs.order_by())
+        labels = self.get_labels([row[key] for row in rows], key)
+        
+        self.results = ResultSet(len(self.annotate))
+        for row in rows:
+            values = []
+            for field, func in self.annotate:
+                if func is DistinctCount:
+                    values.append(distinct[field].get(row[key]))
+                else:
+                    values.append(estimate(func, row[field], row[SAMPLE_ROWS],
+                                           self.sample_every))
+            self.results.append(row[key], self.get_value(row, key, labels), values)
+        column = None
+        if self.sort_by:
+            column = self.sort_by - 1
+        self.results.sort(column, reverse=self.sort_type == 'desc')
+        self.result_count = None
+        if self.list_per_page:
+            self.result_count = len(self.results)
+            self.results = self.results[self.get_window()]
+    
+    def get_snapshot(self):
+        "Materialized (rows, aggregation data) matching the params, if any"
+        if not self.materialize:
+            return None
+        from reporting import materialize
+        return materialize.get_snapshot(self)
+    
+    def get_window(self):
+        "Slice of group rows shown on the current page"
+        offset = self.page_num * self.list_per_page
+        return slice(offset, offset + self.list_per_page)
+    
+    def page_count(self):
+        if not self.list_per_page:
+            return 1
+        return max(1, (self.result_count + self.list_per_page - 1) // self.list_per_page)
+    
+    def page_links(self):
+        "Links to the first, last and nearby pages, None marks a gap"
+        pages = self.page_count()
+        nums = set([0, pages - 1])
+        nums.update(range(max(0, self.page_num - 3), min(pages, self.page_num + 4)))
+        result, last = [], None
+        for num in sorted(nums):
+            if last is not None and num - last > 1:
+                result.append((None, '...', False))
+            url = self.get_query_string({PAGE_VAR: num})
+            result.append((url, num + 1, num == self.page_num))
+            last = num
+        return result
+    
+    def get_ordering(self):
+        """
+        Returns order_by() arguments for the selected sort column, or None
+        when sorting by a related group by field which is ordered by its
+        label in sort_results
+        """
+        prefix = {'asc': '', 'desc': '-'}[self.sort_type]
+        if self.sort_by == 0:
+            if self.is_related_lookup(self.selected_group_by):
+                return None
+            return [prefix + self.selected_group_by]
+        field = self.annotate[self.sort_by - 1][0]
+        return [prefix + field, self.selected_group_by]
+    
+    def sort_results(self):
+        """
+        Sorts results by the group by label, which is only known after
+        the labels have been resolved
+        """
+        self.results.sort(reverse=self.sort_type == 'desc')
+    
+    def derives_aggregation(self):
+        "True if get_results computes the aggregation from its rows, without a query"
+        if self.nested or self.bucket or self.approximate:
+            return False
+        if self.list_per_page and self.get_ordering() is not None:
+            return False
+        return self.derive_aggregation([]) is not None
     
     def get_aggregation(self):
         if self.aggregate is None:
             return None
+        if self._aggregation is None:
+            self._aggregation = self.timed('aggregation',
+                lambda: self.get_cached('aggregation', self.compute_aggregation))
+        return self._aggregation
+    
+    def compute_aggregation(self):
+        if self.derived_aggregation is not None:
+            return self.derived_aggregation
+        if self.approximate:
+            return self.compute_approximate_aggregation()
         aggregate_args = {}
         for field, func in self.aggregate:
             aggregate_args[field] = func(field)
         
         data = self.get_queryset().aggregate(**aggregate_args)
-        
+        return self.format_aggregation(data)
+    
+    def compute_approximate_aggregation(self):
+        "Aggregation estimated like get_approximate_results"
+        aggregate_args = {SAMPLE_ROWS: Count('pk')}
+        for field, func in self.aggregate:
+            if func is not DistinctCount:
+                aggregate_args[field] = func(field)
+        data = self.get_sample_queryset().aggregate(**aggregate_args)
+        for field, func in self.aggregate:
+            if func is not DistinctCount:
+                data[field] = estimate(func, data[field], data[SAMPLE_ROWS],
+                                       self.sample_every)
+            elif self.use_sketches():
+                sketch = merge_all(self.get_sketches(field).values())
+                data[field] = sketch and sketch.estimate()
+            else:
+                data[field] = self.get_queryset().aggregate(
+                    **{field: DistinctCount(field)})[field]
+        return self.format_aggregation(data)
+    
+    def format_aggregation(self, data):
         result = []
         ind = 0
         for field, func in self.aggregate:
@@ -143,19 +809,86 @@ class Report(object):
             result.append((title, data[field]))
             ind += 1
         return result
-            
     
-    def get_value(self, data, field):
+    def derive_aggregation(self, rows):
+        """
+        Computes the aggregation from the annotated rows of all groups when
+        every aggregate decomposes over groups: Sum, Count, Min and Max of an
+        annotated column, Avg from Sum and Count of the field. Returns None
+        if any of them does not, or if groups may share rows. The result
+        is a dict like the one returned by QuerySet.aggregate()
+        """
+        if self.aggregate is None or not self.is_single_valued_lookup(self.selected_group_by):
+            return None
+        columns = {}
+        for field, func in self.annotate:
+            columns[(field, func)] = [row[field] for row in rows if row[field] is not None]
+        
+        def total(values):
+            if not values:
+                return None
+            return sum(values)
+        
+        data = {}
+        for field, func in self.aggregate:
+            values = columns.get((field, func))
+            if func in (Sum, Count) and values is not None:
+                data[field] = total(values)
+                if func is Count:
+                    data[field] = data[field] or 0
+            elif func in (Min, Max) and values is not None:
+                data[field] = None
+                if values:
+                    data[field] = {Min: min, Max: max}[func](values)
+            elif func is Avg:
+                sums, counts = columns.get((field, Sum)), self.count_column(columns, field)
+                if sums is None or counts is None:
+                    return None
+                count = total(counts)
+                data[field] = None
+                if count:
+                    data[field] = float(total(sums)) / count
+            else:
+                return None
+        return data
+    
+    def count_column(self, columns, field):
+        "Per group counts of non null ``field`` values, if annotated"
+        if (field, Count) in columns:
+            return columns[(field, Count)]
+        try:
+            nullable = self.get_field(field).null
+        except FieldDoesNotExist:
+            return None
+        if not nullable:
+            return columns.get((self.model._meta.pk.name, Count))
+        return None
+    
+    def get_value(self, data, field, labels=None):
         value = data[field]
-        if '__' in field:
-            return get_lookup_value(self.model, value, field)
-        field_obj = self.get_field(field)
-        if isinstance(field_obj, models.ForeignKey):
-            return get_lookup_value(self.model, value, field)
-        return value
+        if labels is None:
+            labels = self.get_labels([value], field)
+        return labels.get(value, value)
+    
+    def get_labels(self, values, field):
+        "Maps group by values to their display labels"
+        lookup = self.spec.lookups.get(field)
+        if lookup is None:
+            compute = lambda: get_lookup_values(self.model, values, field, self.database)
+        elif lookup.related_model is None:
+            return dict((v, v) for v in values)
+        else:
+            compute = lambda: get_related_labels(lookup.related_model, values, self.database)
+        return self.timed('labels', compute, len)
     
     def get_headers(self):
-        output = [Header(self, 0, self.get_lookup_title(self.selected_group_by))]
+        if self.bucket:
+            title = '%s (%s)' % (self.get_lookup_title(self.date_hierarchy), self.bucket)
+        else:
+            title = self.get_lookup_title(self.selected_group_by)
+        if self.nested:
+            title = ' / '.join([self.group_by_titles[f] for f in self.group_by_levels])
+        output = [Header(self, 0, title)]
         ind = 1
         for title in self.annotate_titles:
             output.append(Header(self, ind, title))
@@ -169,29 +902,75 @@ class Report(object):
         return [self.get_lookup_title(i) for i in self.detail_list_display]
     
     def get_group_by_field(self):
-        return self.params.get(GROUP_BY_VAR, self.group_by[0])
+        return self.get_group_by_levels()[0]
     
-    def get_queryset(self):
-        lookup_params = self.params.copy()
-        qs = self.model.objects.all()
-        for field in [GROUP_BY_VAR, SORT_VAR, SORTTYPE_VAR, DETAILS_SWITCH_VAR]:
-            if field in lookup_params:
-                del lookup_params[field]
-        for key, value in lookup_params.items():
-            if not isinstance(key, str):
-                # 'key' will be used as a keyword argument later, so Python
-                # requires it to be a string.
-                del lookup_params[key]
-                lookup_params[smart_str(key)] = value
-
+    def get_group_by_levels(self):
+        "Comma separated group by fields select nested grouping"
+        levels = self.params.get(GROUP_BY_VAR, self.group_by[0]).split(',')
+        if len(levels) == 1 and self.get_bucket_kind(levels[0]):
+            return levels
+        for field in levels:
+            if field not in self.group_by:
+                raise IncorrectLookupParameters("Invalid group by '%s'" % field)
+        if len(set(levels)) != len(levels):
+            raise IncorrectLookupParameters("Repeated group by field")
+        return levels
+    
+    def get_bucket_kind(self, group_by):
+        """
+        Time series bucket selected by a group by param like 'hire_date:month',
+        only available for a date_hierarchy field of the report model itself
+        """
+        if not self.date_hierarchy or '__' in self.date_hierarchy:
+            return None
+        field, sep, kind = group_by.partition(':')
+        if field != self.date_hierarchy or kind not in timeseries.KINDS:
+            return None
+        return kind
+    
+    def get_int_param(self, name, default, max_value=None):
+        value = self.params.get(name, default)
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise IncorrectLookupParameters("Invalid value '%s' for '%s'" % (value, name))
+        if value < 0 or (max_value is not None and value > max_value):
+            raise IncorrectLookupParameters("Value '%s' for '%s' is out of range" % (value, name))
+        return value
+    
+    def get_lookup_params(self):
+        """
+        filter() arguments built from the request params, validated up front
+        and checked against the report's guards
+        """
+        lookup_params = {}
+        allowed = guards.allowed_lookups(self)
+        for key, value in self.params.items():
+            if key in CONTROL_VARS:
+                continue
+            # 'key' will be used as a keyword argument later, so Python
+            # requires it to be a string.
+            key = smart_str(key)
+            validate_lookup(self.model, key)
             # if key ends with __in, split parameter into separate values
             if key.endswith('__in'):
-                lookup_params[key] = value.split(',')
-        try:
-            qs = qs.filter(**lookup_params)
-        except:
-            raise IncorrectLookupParameters
-        return qs
+                value = value.split(',')
+            guards.check_lookup(self, key, value, allowed)
+            lookup_params[key] = value
+        return lookup_params
+    
+    def get_queryset(self):
+        """
+        Filtered queryset, built once per report. A fresh clone is returned
+        so that evaluating it does not fill the shared result cache
+        """
+        if self._queryset is None:
+            try:
+                qs = db.route(self.model.objects.all(), self.database)
+                self._queryset = qs.filter(**self.lookup_params)
+            except (ValueError, TypeError, ValidationError), e:
+                raise IncorrectLookupParameters("Invalid filter value: %s" % e)
+        return self._queryset.all()
         
 
     def get_filters(self, model_admin):
@@ -199,16 +978,33 @@ class Report(object):
         if self.list_filter:
             #fields = []
             for field_name in self.list_filter:
-                try:
-                    field = self.get_field(field_name)
-                except:
-                    filter_specs.append(LookupFilterSpec(field_name, self.request, self.params, self.model, model_admin))
-                    continue
-                spec = FilterSpec.create(field, self.request, self.params, self.model, model_admin)
-                if spec and spec.has_output():
+                spec = self.get_filter(field_name, model_admin)
+                if spec is not None:
                     filter_specs.append(spec)
         return filter_specs, bool(filter_specs)
     
+    def get_filter(self, field_name, model_admin):
+        return self.timed('filter %s' % field_name,
+                          lambda: self.create_filter(field_name, model_admin))
+    
+    def create_filter(self, field_name, model_admin):
+        try:
+            field = self.get_field(field_name)
+        except FieldDoesNotExist:
+            spec = LookupFilterSpec(field_name, self.request, self.params, self.model,
+                                    model_admin, using=self.database)
+            # query the choices now, in the filter's task when loading in parallel
+            spec.get_values()
+            return spec
+        if field.rel:
+            spec = RoutedRelatedFilterSpec(field, self.request, self.params, self.model,
+                                           model_admin, using=self.database)
+        else:
+            spec = FilterSpec.create(field, self.request, self.params, self.model, model_admin)
+        if spec and spec.has_output():
+            return spec
+        return None
+    
     def get_query_string(self, new_params=None, remove=None):
         if new_params is None: new_params = {}
         if remove is None: remove = []
@@ -228,10 +1024,29 @@ class Report(object):
     def group_by_links(self):
         result = []
         for f in self.group_by:
-            url = './' + self.get_query_string({GROUP_BY_VAR:f})
+            url = './' + self.get_query_string({GROUP_BY_VAR:f, PAGE_VAR: None})
             name = self.group_by_titles[f]
-            selected = self.params.get(GROUP_BY_VAR, self.group_by[0]) == f
+            selected = self.group_by_levels == [f]
             result.append((url, name, selected))
+        if self.get_bucket_kind('%s:day' % self.date_hierarchy):
+            title = self.get_lookup_title(self.date_hierarchy)
+            for kind in timeseries.KINDS:
+                f = '%s:%s' % (self.date_hierarchy, kind)
+                url = './' + self.get_query_string({GROUP_BY_VAR: f, PAGE_VAR: None})
+                result.append((url, '%s by %s' % (title, kind), self.bucket == kind))
+        return result
+    
+    def nested_group_by_links(self):
+        "Links adding another group by level"
+        result = []
+        if self.bucket:
+            return result
+        for f in self.group_by:
+            if f in self.group_by_levels:
+                continue
+            levels = ','.join(self.group_by_levels + [f])
+            url = './' + self.get_query_string({GROUP_BY_VAR: levels, PAGE_VAR: None})
+            result.append((url, self.group_by_titles[f]))
         return result
     
 
@@ -239,25 +1054,112 @@ class Report(object):
         val = row[self.selected_group_by]
         key = str(self.selected_group_by)
         queryset = self.get_queryset().filter(**{key: val})
-        output = []
-        for obj in queryset:
-            item = []
-            for attr in self.detail_list_display:
-                if hasattr(obj, attr):
-                    value = getattr(obj, attr)
-                elif hasattr(self, attr):
-                    value = getattr(self, attr)
-                    if callable(value):
-                        value = value(obj)
-                else:
-                    raise Exception("Couldnot resove '%s' into value" % attr)
-                if attr in self.detail_link_fields:
-                    value = mark_safe('<a href="%s">%s</a>' % 
-                                      (self.details_url(obj), escape(value)))
-                item.append(value)
-            output.append(item)
+        return [self.get_details_row(obj) for obj in queryset]
+    
+    def get_details_fields(self):
+        """
+        Returns ``detail_list_display`` if all of its items are concrete model
+        fields (so details can be fetched with values()), None otherwise
+        """
+        for attr in self.detail_list_display:
+            try:
+                field = self.get_field(attr)
+            except FieldDoesNotExist:
+                return None
+            if isinstance(field, models.ManyToManyField):
+                return None
+        return list(self.detail_list_display)
+    
+    def get_all_details(self, keys=None):
+        """
+        Fetches details of all groups with one query ordered by the group by
+        field and buckets them by group by value in a single pass. Only
+        ``details_limit`` rows are kept per group, the number of skipped rows
+        is stored in ``self.details_skipped``. If ``keys`` are given only
+        details of these groups are fetched.
+        """
+        key = str(self.selected_group_by)
+        qs = self.get_queryset().order_by(key)
+        if keys is not None:
+            qs = qs.filter(in_lookup(key, keys))
+        fields = self.get_details_fields()
+        if fields is None and self.is_single_valued_lookup(key):
+            # the group value is read from the instance, following the
+            # foreign keys of the lookup loaded along with it
+            if LOOKUP_SEP in key:
+                qs = qs.select_related(key.rsplit(LOOKUP_SEP, 1)[0])
+            source = ((lookup_value(obj, key), obj) for obj in qs.iterator())
+        elif fields is None:
+            keys = dict(qs.values_list('pk', key).iterator())
+            source = ((keys[obj.pk], obj) for obj in qs.iterator())
+        else:
+            columns = ['pk', key] + [f for f in fields if f != key]
+            source = ((row[key], row) for row in qs.values(*columns).iterator())
+        
+        buckets, self.details_skipped = {}, {}
+        limit = self.details_limit
+        for value, obj in source:
+            bucket = buckets.setdefault(value, [])
+            if limit is not None and len(bucket) >= limit:
+                self.details_skipped[value] = self.details_skipped.get(value, 0) + 1
+                continue
+            bucket.append(obj)
+        
+        if fields is not None:
+            self.resolve_details_labels(buckets, fields)
+        output = {}
+        for value, objects in buckets.items():
+            output[value] = [self.get_details_row(obj) for obj in objects]
         return output
     
+    def resolve_details_labels(self, buckets, fields):
+        "Replaces related field ids in values() rows with their labels"
+        for attr in fields:
+            if not isinstance(self.get_field(attr), RelatedField):
+                continue
+            rows = [row for bucket in buckets.values() for row in bucket]
+            labels = get_lookup_values(self.model, [row[attr] for row in rows], attr,
+                                       self.database)
+            for row in rows:
+                row[attr] = labels[row[attr]]
+    
+    def get_details_row(self, obj, links=True):
+        """
+        Builds a details row either from a model instance or from a values()
+        dict. In the latter case details_url receives an instance holding pk only
+        """
+        item = []
+        for attr in self.detail_list_display:
+            if isinstance(obj, dict):
+                value = obj[attr]
+            elif hasattr(obj, attr):
+                value = getattr(obj, attr)
+            elif hasattr(self, attr):
+                value = getattr(self, attr)
+                if callable(value):
+                    value = value(obj)
+            else:
+                raise Exception("Couldnot resove '%s' into value" % attr)
+            if links and attr in self.detail_link_fields:
+                if isinstance(obj, dict):
+                    url = self.details_url(self.model(pk=obj['pk']))
+                else:
+                    url = self.details_url(obj)
+                value = mark_safe('<a href="%s">%s</a>' % (url, escape(value)))
+            item.append(value)
+        return item
+    
+    def export_links(self):
+        "Exports are flat, there are none for nested group by"
+        result = []
+        if self.nested:
+            return result
+        for format, title in [('csv', 'CSV'), ('jsonl', 'JSON Lines')]:
+            url = reverse('reporting-export', args=[self.get_slug(), format])
+            query = self.get_query_string({PAGE_VAR: None, LIMIT_VAR: None})
+            result.append((url + query, title))
+        return result
+    
     def details_url(self, obj):
         view_name = 'admin:%s_%s_change' % (obj._meta.app_label, obj._meta.module_name)
         return reverse(view_name, args=[obj.pk])
@@ -274,43 +1176,43 @@ class Report(object):
             title = 'Show'
             url = self.get_query_string({DETAILS_SWITCH_VAR:'y'})
         return '<a href="%s">%s</a>' % (url, title)
+    
+    def approximate_switch(self):
+        "Link for switching between sampled and exact values"
+        if not self.__class__.approximate:
+            return None
+        if self.approximate:
+            title = 'Exact values'
+            url = self.get_query_string({EXACT_VAR: 'y', PAGE_VAR: None})
+        else:
+            title = 'Sampled values'
+            url = self.get_query_string({EXACT_VAR: None, PAGE_VAR: None})
+        return '<a href="%s">%s</a>' % (url, title)
         
     
     def get_field(self, name):
-        return get_model_field(self.model, name)
+        lookup = self.spec.lookups.get(name)
+        if lookup is None:
+            return get_model_field(self.model, name)
+        if lookup.field is None:
+            raise FieldDoesNotExist(name)
+        return lookup.field
     
-    def get_lookup_title(self, lookup):
+    def is_single_valued_lookup(self, lookup):
+        "True if ``lookup`` only follows forward foreign keys"
+        if lookup in self.spec.lookups:
+            return self.spec.lookups[lookup].single_valued
+        return is_single_valued(self.model, lookup)
+    
+    def is_related_lookup(self, lookup):
+        if lookup in self.spec.lookups:
+            return self.spec.lookups[lookup].related_model is not None
         try:
-            return capfirst(self.get_field(lookup).verbose_name)
+            return isinstance(get_lookup_field(self.model, lookup), RelatedField)
         except FieldDoesNotExist:
-            if '__' not in lookup and not hasattr(self, lookup):
-                raise
-            parts = lookup.split('__')
-            return ', '.join([capfirst(i.replace('_', ' ')) for i in parts])
-    
-    def split_annotate_titles(self, items):
-        data, titles = [], []
-        for item in items:
-            if len(item) == 3:
-                data.append(item[:2])
-                titles.append(item[-1])
-            else:
-                data.append(item)
-                field_name = self.get_lookup_title(item[0])
-                text = '%s %s' % (field_name, item[1].__name__)
-                titles.append(text)
-        return data, titles
+            return False
     
-    def split_titles(self, items):
-        data, titles = [], {}
-        for item in items:
-            if not isinstance(item, (list, tuple)):
-                data.append(item)
-                titles[item] = self.get_lookup_title(item)
-            else:
-                assert len(item) == 2
-                data.append(item[0])
-                titles[item[0]] = item[1]
-        return data, titles
-                
-       
+    def get_lookup_title(self, lookup):
+        if lookup in self.spec.lookups and self.spec.lookups[lookup].title is not None:
+            return self.spec.lookups[lookup].title
+        return lookup_title(self, lookup)
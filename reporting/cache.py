@@ -0,0 +1,113 @@
+import time
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.hashcompat import md5_constructor
+from django.utils.importlib import import_module
+from django.db.models.signals import post_save, post_delete
+
+
+class LRUCache(object):
+    """
+    In-process cache holding at most ``max_entries`` values, least recently
+    used ones are evicted first. Has the same get/set/delete interface as
+    django.core.cache.cache
+    """
+    def __init__(self, max_entries=100):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires < time.time():
+                return default
+            self._data[key] = (expires, value)
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires = None
+        if timeout:
+            expires = time.time() + timeout
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_backend = None
+
+def get_backend():
+    """
+    Returns the backend configured by REPORTING_CACHE_BACKEND: 'lru' (default),
+    'django' for django.core.cache.cache or a dotted path to a callable
+    """
+    global _backend
+    if _backend is None:
+        name = getattr(settings, 'REPORTING_CACHE_BACKEND', 'lru')
+        if name == 'lru':
+            _backend = LRUCache(getattr(settings, 'REPORTING_CACHE_MAX_ENTRIES', 100))
+        elif name == 'django':
+            from django.core.cache import cache
+            _backend = cache
+        else:
+            module, attr = name.rsplit('.', 1)
+            _backend = getattr(import_module(module), attr)()
+    return _backend
+
+
+def normalize_params(params):
+    "Params as a sorted list of pairs, __in values are sorted too"
+    result = []
+    for key, value in params.items():
+        if key.endswith('__in'):
+            value = ','.join(sorted(value.split(',')))
+        result.append((key, value))
+    result.sort()
+    return result
+
+def get_generation(slug):
+    """
+    Every cache key includes the report generation, changing it makes all
+    cached values of the report unreachable
+    """
+    backend = get_backend()
+    key = 'reporting:generation:%s' % md5_constructor(slug).hexdigest()
+    generation = backend.get(key)
+    if generation is None:
+        generation = repr(time.time())
+        backend.set(key, generation)
+    return generation
+
+def make_key(slug, params, group_by, name):
+    raw = repr((slug, get_generation(slug), normalize_params(params), group_by, name))
+    return 'reporting:%s' % md5_constructor(raw).hexdigest()
+
+def invalidate(slug):
+    backend = get_backend()
+    key = 'reporting:generation:%s' % md5_constructor(slug).hexdigest()
+    backend.set(key, repr(time.time()))
+
+
+def connect_invalidation(slug, models):
+    "Invalidates report ``slug`` whenever any of ``models`` is saved or deleted"
+    def handler(sender, **kwargs):
+        invalidate(slug)
+    for model in models:
+        uid = 'reporting:%s:%s' % (slug, model._meta)
+        post_save.connect(handler, sender=model, weak=False, dispatch_uid=uid)
+        post_delete.connect(handler, sender=model, weak=False, dispatch_uid=uid)
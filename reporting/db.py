@@ -0,0 +1,120 @@
+"""
+Database routing of report queries. A report reads from the database alias
+in its ``using`` attribute, or REPORTING_DATABASE, instead of the default
+database. With a lag tolerance (``replica_max_lag`` or
+REPORTING_REPLICA_MAX_LAG, in seconds) the replica is only used while its
+replication lag, checked at most every REPORTING_REPLICA_LAG_CHECK seconds,
+is within it; otherwise, or when the lag can not be determined, reports
+fall back to the default database. Needs a Django version with multiple
+database support.
+"""
+import logging
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.utils.importlib import import_module
+
+from reporting.cache import LRUCache
+
+try:
+    from django.db import connections, DEFAULT_DB_ALIAS
+except ImportError:
+    connections, DEFAULT_DB_ALIAS = None, 'default'
+
+
+logger = logging.getLogger('reporting')
+
+_lags = LRUCache(100)
+
+
+def get_connection(alias):
+    if alias is None:
+        return connection
+    return connections[alias]
+
+def route(queryset, alias):
+    "``queryset`` reading from database ``alias``, None for the default one"
+    if alias is None:
+        return queryset
+    return queryset.using(alias)
+
+def get_sql(queryset, alias):
+    "SQL and params of ``queryset`` for database ``alias``"
+    query = queryset.query
+    if hasattr(query, 'get_compiler'):
+        return query.get_compiler(alias or DEFAULT_DB_ALIAS).as_sql()
+    return query.as_sql()
+
+def close_connections():
+    "Closes the current thread's connections to all databases"
+    if connections is None:
+        connection.close()
+        return
+    for alias in connections:
+        connections[alias].close()
+
+
+def database_lag(alias):
+    """
+    Replication lag of ``alias`` in seconds, for PostgreSQL and MySQL
+    replicas. None if it is not known
+    """
+    conn = connections[alias]
+    cursor = conn.cursor()
+    engine = conn.settings_dict['ENGINE']
+    if 'postgresql' in engine:
+        cursor.execute("SELECT CASE WHEN pg_is_in_recovery() THEN "
+                       "EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) "
+                       "ELSE 0 END")
+        return cursor.fetchone()[0]
+    if 'mysql' in engine:
+        cursor.execute('SHOW SLAVE STATUS')
+        row = cursor.fetchone()
+        if row is None:
+            return 0
+        columns = [c[0] for c in cursor.description]
+        return dict(zip(columns, row)).get('Seconds_Behind_Master')
+    return None
+
+def get_lag_function():
+    path = getattr(settings, 'REPORTING_REPLICA_LAG_FUNCTION', None)
+    if path is None:
+        return database_lag
+    module, attr = path.rsplit('.', 1)
+    return getattr(import_module(module), attr)
+
+def get_lag(alias):
+    hit = _lags.get(alias)
+    if hit is None:
+        try:
+            lag = get_lag_function()(alias)
+        except Exception, e:
+            logger.warning('Could not check replication lag of %s: %s' % (alias, e))
+            lag = None
+        hit = (lag,)
+        _lags.set(alias, hit, getattr(settings, 'REPORTING_REPLICA_LAG_CHECK', 10))
+    return hit[0]
+
+
+def choose_database(report):
+    """
+    Alias of the database ``report`` should read from, None for the default
+    database
+    """
+    alias = report.using or getattr(settings, 'REPORTING_DATABASE', None)
+    if alias is None or alias == DEFAULT_DB_ALIAS:
+        return None
+    if connections is None:
+        raise ImproperlyConfigured("Report database '%s' needs multiple database support" % alias)
+    max_lag = report.replica_max_lag
+    if max_lag is None:
+        max_lag = getattr(settings, 'REPORTING_REPLICA_MAX_LAG', None)
+    if max_lag is None:
+        return alias
+    lag = get_lag(alias)
+    if lag is None or lag > max_lag:
+        logger.info('Replica %s lags %s seconds, reading from the default database'
+                    % (alias, lag))
+        return None
+    return alias
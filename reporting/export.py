@@ -0,0 +1,166 @@
+import csv
+from cStringIO import StringIO
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import simplejson
+from django.utils.encoding import smart_str, force_unicode
+
+from reporting.results import ResultSet
+
+
+def get_chunk_size():
+    return getattr(settings, 'REPORTING_EXPORT_CHUNK_SIZE', 1000)
+
+def chunked(queryset, size):
+    """
+    Reads ``queryset`` with a single query, without caching it, and yields
+    its rows in lists of ``size``. Slicing the query instead would run it
+    again for every chunk and have the database skip all the previous rows
+    """
+    chunk = []
+    for row in queryset.iterator():
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_groups(report, by_key=False):
+    """
+    Yields (group by value, row values) in the report ordering, or ordered
+    by group by value if ``by_key`` is set. Related group by fields can not
+    be sorted by label in the database, so they are exported by value too
+    """
+    if report.bucket:
+        report.get_time_series_results()
+        for row in report.results:
+            yield row.key, row.values
+        return
+    key = report.selected_group_by
+    ordering = None
+    if not by_key:
+        ordering = report.get_ordering()
+    rows = report.get_annotated_queryset().order_by(*(ordering or [key]))
+    for chunk in chunked(rows, get_chunk_size()):
+        labels = report.get_labels([row[key] for row in chunk], key)
+        for row in chunk:
+            values = [report.get_value(row, key, labels)]
+            values.extend([row[field] for field, func in report.annotate])
+            yield row[key], values
+
+def iter_details(report, links=False):
+    "Yields (group by value, details row) ordered by group by value"
+    key = str(report.selected_group_by)
+    qs = report.get_queryset().order_by(key, 'pk')
+    fields = report.get_details_fields()
+    if fields is None:
+        for chunk in chunked(qs, get_chunk_size()):
+            pks = [obj.pk for obj in chunk]
+            keys = dict(report.get_queryset().filter(pk__in=pks).values_list('pk', key))
+            for obj in chunk:
+                yield keys[obj.pk], report.get_details_row(obj, links)
+    else:
+        columns = ['pk', key] + [f for f in fields if f != key]
+        for chunk in chunked(qs.values(*columns), get_chunk_size()):
+            report.resolve_details_labels({None: chunk}, fields)
+            for row in chunk:
+                yield row[key], report.get_details_row(row, links)
+
+def iter_rows(report, details=False):
+    """
+    Yields ('group', values) for every group, followed by ('detail', values)
+    for its details if ``details`` is set. Groups and details are each read
+    with one query and merged by group by value, so only a chunk of rows is
+    held as model instances or labels at a time (the database driver may
+    still buffer the raw rows)
+    """
+    groups = iter_groups(report, by_key=details)
+    if not details:
+        for value, row in groups:
+            yield 'group', row
+        return
+    detail_rows = iter_details(report)
+    pending = next(detail_rows, None)
+    for value, row in groups:
+        yield 'group', row
+        while pending is not None and pending[0] == value:
+            yield 'detail', pending[1]
+            pending = next(detail_rows, None)
+
+def iter_result_sets(report, size=None):
+    """
+    Yields the results of ``report`` as ResultSets of at most ``size`` groups
+    with their details, read like the exports. Used to stream large reports
+    into the page
+    """
+    size = size or get_chunk_size()
+    details = bool(report.detail_list_display and report.show_details)
+    if details:
+        detail_rows = iter_details(report, links=True)
+        pending = next(detail_rows, None)
+    results = ResultSet(len(report.annotate))
+    for value, row in iter_groups(report, by_key=details):
+        index = results.append(value, row[0], row[1:])
+        if details:
+            rows, skipped = [], 0
+            while pending is not None and pending[0] == value:
+                if report.details_limit is None or len(rows) < report.details_limit:
+                    rows.append(pending[1])
+                else:
+                    skipped += 1
+                pending = next(detail_rows, None)
+            results.details[index] = rows
+            results.details_more[index] = skipped or None
+        if len(results) == size:
+            yield results
+            results = ResultSet(len(report.annotate))
+    if len(results):
+        yield results
+
+
+def export_csv(report, details=False):
+    "Group rows use report headers, detail rows are indented by one column"
+    buf = StringIO()
+    writer = csv.writer(buf)
+    def line(values):
+        writer.writerow([smart_str(v) for v in values])
+        data = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        return data
+    yield line([h.text for h in report.get_headers()])
+    if details:
+        yield line([''] + report.get_details_headers())
+    for kind, values in iter_rows(report, details):
+        if kind == 'detail':
+            values = [''] + values
+        yield line(values)
+
+
+class ExportEncoder(DjangoJSONEncoder):
+    def default(self, o):
+        try:
+            return DjangoJSONEncoder.default(self, o)
+        except TypeError:
+            return force_unicode(o)
+
+def export_jsonl(report, details=False):
+    "One JSON object per line, keyed by column titles"
+    titles = [force_unicode(h.text) for h in report.get_headers()]
+    details_titles = []
+    if details:
+        details_titles = [force_unicode(t) for t in report.get_details_headers()]
+    for kind, values in iter_rows(report, details):
+        keys = kind == 'group' and titles or details_titles
+        data = dict(zip(keys, values))
+        data['type'] = kind
+        yield simplejson.dumps(data, cls=ExportEncoder) + '\n'
+
+
+EXPORTS = {
+    'csv': (export_csv, 'text/csv'),
+    'jsonl': (export_jsonl, 'application/x-ndjson'),
+}
@@ -1,13 +1,31 @@
-from django.contrib.admin.filterspecs import FilterSpec
+from django.contrib.admin.filterspecs import FilterSpec, RelatedFilterSpec
+from django.db.models import ManyToManyField
 from django.db.models.fields.related import RelatedField
 from django.template.defaultfilters import capfirst
+from django.conf import settings
+from django.utils.encoding import smart_unicode
+from django.utils.hashcompat import md5_constructor
+import cache
+import db
+
+
+SHOW_ALL_CHOICES_VAR = 'fa'
 
 
 class LookupFilterSpec(FilterSpec):
-    def __init__(self, f, request, params, model, model_admin):
+    """
+    Filter for lookups spanning relations. Choices are the distinct values
+    of the last field in the lookup, at most REPORTING_FILTER_CHOICES_LIMIT
+    of them unless expanded with 'More...', cached for
+    REPORTING_FILTER_CHOICES_TIMEOUT seconds
+    """
+    def __init__(self, f, request, params, model, model_admin, using=None):
         FilterSpec.__init__(self, f, request, params, model, model_admin)
         self.model = model
+        self.using = using
         self.lookup_val = request.GET.get(f, None)
+        self.expanded = f in params.get(SHOW_ALL_CHOICES_VAR, '').split(',')
+        self.loaded = None
     
     def title(self):
         return capfirst(' '.join([i for i in self.field.split('__')]))
@@ -16,14 +34,47 @@ class LookupFilterSpec(FilterSpec):
         yield {'selected': self.lookup_val is None,
                'query_string': cl.get_query_string({}, [self.field]),
                'display': 'All'}
-        values = self._values(self.model, self.field)
+        values, more = self.get_values()
+        if self.lookup_val is not None and self.lookup_val not in [v[0] for v in values]:
+            values.append((self.lookup_val, self.lookup_val))
         for val in values:
             id, display = val
             yield {'selected': self.lookup_val == id,
                    'query_string': cl.get_query_string({self.field: id}),
                    'display': display}
+        if more:
+            expanded = cl.params.get(SHOW_ALL_CHOICES_VAR, '').split(',')
+            expanded = ','.join([f for f in expanded if f] + [self.field])
+            yield {'selected': False,
+                   'query_string': cl.get_query_string({SHOW_ALL_CHOICES_VAR: expanded}),
+                   'display': 'More...'}
+    
+    def get_values(self):
+        "Returns (choices, True if there are more than shown), read once"
+        if self.loaded is None:
+            self.loaded = self.load_values()
+        values, more = self.loaded
+        return list(values), more
+    
+    def load_values(self):
+        limit = None
+        if not self.expanded:
+            limit = getattr(settings, 'REPORTING_FILTER_CHOICES_LIMIT', None)
+        timeout = getattr(settings, 'REPORTING_FILTER_CHOICES_TIMEOUT', 0)
+        raw = repr((self.model._meta, self.field, limit, self.using))
+        key = 'reporting:choices:%s' % md5_constructor(raw).hexdigest()
+        if timeout:
+            hit = cache.get_backend().get(key)
+            if hit is not None:
+                return list(hit[0]), hit[1]
+        values = self._values(self.model, self.field, limit)
+        more = limit is not None and len(values) > limit
+        values = values[:limit]
+        if timeout:
+            cache.get_backend().set(key, (values, more), timeout)
+        return list(values), more
     
-    def _values(self, model, lookup):
+    def _values(self, model, lookup, limit=None):
         parts = lookup.split('__')
         field = model._meta.get_field(parts[0])
         if not isinstance(field, RelatedField):
@@ -31,13 +82,38 @@ class LookupFilterSpec(FilterSpec):
         rel_model = field.rel.to
         if len(parts) == 2:
             field2 = rel_model._meta.get_field(parts[1])
-            ids = [i[0] for i in field.get_choices(include_blank=False)]
-            values = set(rel_model.objects.filter(pk__in=ids).values_list(parts[1], flat=True))
-            if field2.choices:
-                labels = dict(field2.choices)
-                return [(unicode(v), labels[v]) for v in values]
-            return [(v,v) for v in values]
+            values = db.route(rel_model.objects.all(), self.using)
+            values = values.values_list(parts[1], flat=True)
+            values = values.distinct().order_by(parts[1])
+            if limit is not None:
+                values = values[:limit + 1]
+            labels = dict(field2.choices)
+            return [(unicode(v), labels.get(v, v)) for v in values]
         next_lookup = '__'.join(parts[1:])
-        return self._values(rel_model, next_lookup)
+        return self._values(rel_model, next_lookup, limit)
+
+
+class RoutedRelatedFilterSpec(RelatedFilterSpec):
+    "The admin's filter on related objects, reading its choices from database ``using``"
+    def __init__(self, f, request, params, model, model_admin, using=None):
+        FilterSpec.__init__(self, f, request, params, model, model_admin)
+        if isinstance(f, ManyToManyField):
+            self.lookup_title = f.rel.to._meta.verbose_name
+        else:
+            self.lookup_title = f.verbose_name
+        rel_name = f.rel.get_related_field().name
+        self.lookup_kwarg = '%s__%s__exact' % (f.name, rel_name)
+        self.lookup_val = request.GET.get(self.lookup_kwarg, None)
+        self.lookup_choices = self.get_choices(f, using)
+
+    def get_choices(self, f, using):
+        "As Field.get_choices(include_blank=False)"
+        if f.choices:
+            return list(f.choices)
+        qs = db.route(f.rel.to._default_manager.complex_filter(f.rel.limit_choices_to), using)
+        if hasattr(f.rel, 'get_related_field'):
+            attname = f.rel.get_related_field().attname
+            return [(getattr(x, attname), smart_unicode(x)) for x in qs]
+        return [(x._get_pk_val(), smart_unicode(x)) for x in qs]
 
 #FilterSpec.filter_specs.insert(0, (lambda f: '__' in f.name, LookupFilterSpec))
@@ -0,0 +1,186 @@
+"""
+Limits on the queries request params can make a report run. Every setting
+can be overridden by the report attribute of the same name in lower case:
+
+REPORTING_MAX_IN_VALUES: most values an ``__in`` filter may list (100)
+REPORTING_STATEMENT_TIMEOUT: seconds a report query may run, PostgreSQL and
+    MySQL only (no limit)
+REPORTING_MAX_QUERY_COST: highest planner cost estimate of the group query,
+    checked with EXPLAIN on PostgreSQL only (no limit)
+
+Filters are only accepted on the report's list_filter, group_by and
+date_hierarchy fields, plus those in ``allowed_lookups``. The cost and time
+limits only apply to reports requested by users: the views check the cost
+and run the queries through ``limited`` or ``limited_iter``, reports built
+internally (incremental snapshots, refresh_reports) are not limited.
+"""
+import re
+import sys
+
+from django.conf import settings
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.db import DatabaseError
+from django.db.models.sql.constants import LOOKUP_SEP, QUERY_TERMS
+
+from reporting import db
+
+
+class QueryRejected(IncorrectLookupParameters):
+    pass
+
+
+def get_limit(report, name, default=None):
+    value = getattr(report, name)
+    if value is None:
+        value = getattr(settings, 'REPORTING_%s' % name.upper(), default)
+    return value
+
+def get_engine(connection):
+    return getattr(connection, 'settings_dict', {}).get('ENGINE') or settings.DATABASE_ENGINE
+
+
+def allowed_lookups(report):
+    allowed = set(report.group_by)
+    allowed.update(report.list_filter or [])
+    allowed.update(report.allowed_lookups or [])
+    if report.date_hierarchy:
+        allowed.add(report.date_hierarchy)
+    return allowed
+
+def check_lookup(report, key, value, allowed):
+    """
+    Raises QueryRejected unless filter ``key`` is on an allowed field, or a
+    field of the model an allowed related field points to (as in the admin's
+    'dept__id__exact'), and lists at most max_in_values values
+    """
+    parts = key.split(LOOKUP_SEP)
+    if len(parts) > 1 and parts[-1] in QUERY_TERMS:
+        parts = parts[:-1]
+    lookup = LOOKUP_SEP.join(parts)
+    parent = LOOKUP_SEP.join(parts[:-1])
+    if lookup not in allowed and not (parent in allowed and report.is_related_lookup(parent)):
+        raise QueryRejected("Filtering on '%s' is not allowed in this report" % key)
+    limit = get_limit(report, 'max_in_values', 100)
+    if key.endswith('__in') and limit is not None and len(value) > limit:
+        raise QueryRejected("Too many values for '%s': %s, at most %s are allowed"
+                            % (key, len(value), limit))
+
+
+def set_statement_timeout(report):
+    """
+    Limits query time on the current thread's connection of the report,
+    PostgreSQL and MySQL only. Returns the previous limit, for
+    reset_statement_timeout, or None if nothing was changed
+    """
+    timeout = get_limit(report, 'statement_timeout')
+    if timeout is None:
+        return None
+    connection = db.get_connection(report.database)
+    engine = get_engine(connection)
+    if 'postgresql' in engine:
+        show, set = 'SHOW statement_timeout', 'SET statement_timeout TO %s'
+    elif 'mysql' in engine:
+        show, set = 'SELECT @@SESSION.max_execution_time', 'SET SESSION max_execution_time = %s'
+    else:
+        return None
+    cursor = connection.cursor()
+    cursor.execute(show)
+    previous = cursor.fetchone()[0]
+    cursor.execute(set % int(timeout * 1000))
+    return previous
+
+def reset_statement_timeout(report, previous):
+    if previous is None:
+        return
+    connection = db.get_connection(report.database)
+    if 'postgresql' in get_engine(connection):
+        connection.cursor().execute('SET statement_timeout TO %s', [previous])
+    else:
+        connection.cursor().execute('SET SESSION max_execution_time = %s', [previous])
+
+def uses_savepoint(connection):
+    "PostgreSQL aborts the transaction on errors, unless in autocommit mode"
+    return 'postgresql' in get_engine(connection) and \
+        not getattr(connection.features, 'uses_autocommit', False)
+
+def limited(report, func):
+    """
+    Calls ``func`` with the statement timeout of ``report`` set on its
+    connection, then restores the previous one, so that the limit does not
+    leak onto later queries of the connection. A timeout is raised as
+    QueryRejected; on PostgreSQL the queries run in a savepoint, so that it
+    does not abort the transaction
+    """
+    report.guarded = True
+    previous = set_statement_timeout(report)
+    if previous is None:
+        return func()
+    connection = db.get_connection(report.database)
+    savepoint = uses_savepoint(connection)
+    if savepoint:
+        connection.cursor().execute('SAVEPOINT reporting_limited')
+    try:
+        result = func()
+    except DatabaseError, e:
+        info = sys.exc_info()
+        if savepoint:
+            connection.cursor().execute('ROLLBACK TO SAVEPOINT reporting_limited')
+        if is_timeout(e):
+            raise timeout_error(report)
+        raise info[0], info[1], info[2]
+    else:
+        if savepoint:
+            connection.cursor().execute('RELEASE SAVEPOINT reporting_limited')
+        return result
+    finally:
+        reset_statement_timeout(report, previous)
+
+def limited_iter(report, chunks):
+    """
+    Iterates ``chunks`` with the statement timeout of ``report`` set, for
+    responses whose queries run while they are sent. Django closes the
+    connection of the request before sending the response, so the queries
+    open a new one, which is closed when done. A timeout is raised as
+    QueryRejected
+    """
+    report.guarded = True
+    try:
+        set_statement_timeout(report)
+        for chunk in chunks:
+            yield chunk
+    except DatabaseError, e:
+        if not is_timeout(e):
+            raise
+        raise timeout_error(report)
+    finally:
+        db.get_connection(report.database).close()
+
+def is_timeout(error):
+    "True if database error ``error`` was raised by a statement timeout"
+    if getattr(error, 'pgcode', None) == '57014':
+        return True
+    message = str(error).lower()
+    return 'statement timeout' in message or 'max_execution_time' in message
+
+def timeout_error(report):
+    return QueryRejected("The report took longer than %s seconds, try narrowing "
+                         "the filters" % get_limit(report, 'statement_timeout'))
+
+
+COST_RE = re.compile(r'cost=[\d.]+\.\.([\d.]+)')
+
+def check_cost(report):
+    "Raises QueryRejected if the group query is estimated to cost too much"
+    limit = get_limit(report, 'max_query_cost')
+    if limit is None:
+        return
+    connection = db.get_connection(report.database)
+    if 'postgresql' not in get_engine(connection):
+        return
+    sql, params = db.get_sql(report.get_annotated_queryset(), report.database)
+    cursor = connection.cursor()
+    cursor.execute('EXPLAIN ' + sql, params)
+    match = COST_RE.search(cursor.fetchone()[0])
+    if match and float(match.group(1)) > limit:
+        raise QueryRejected("The report is too expensive with these filters (cost %s, "
+                            "at most %s), try narrowing them" % (match.group(1), limit))
@@ -0,0 +1,116 @@
+"""
+Background execution of reports. Reports with ``background = True`` are
+computed by a pool of REPORTING_WORKERS threads while the view polls for
+completion. Identical requests share one job, finished jobs are kept for
+REPORTING_JOB_RESULT_TIMEOUT seconds and reused. A failed job is handed
+out once, to report its error, and the next request runs the report again.
+"""
+import logging
+import threading
+import time
+import Queue
+
+from django.conf import settings
+from reporting import db, guards
+from reporting.cache import LRUCache
+
+
+logger = logging.getLogger('reporting')
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+
+class Job(object):
+    def __init__(self, id, func):
+        self.id = id
+        self.func = func
+        self.state = QUEUED
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.finished = None
+
+    def run(self):
+        self.state = RUNNING
+        try:
+            self.result = self.func()
+            self.state = DONE
+        except Exception, e:
+            logger.exception('Report job %s failed' % self.id)
+            self.error = e
+            self.state = FAILED
+        finally:
+            self.finished = time.time()
+            self.func = None
+            db.close_connections()
+
+    def as_dict(self):
+        elapsed = (self.finished or time.time()) - self.submitted
+        return {'id': self.id,
+                'state': self.state,
+                'error': self.error and unicode(self.error) or None,
+                'elapsed': round(elapsed, 3)}
+
+
+class JobQueue(object):
+    def __init__(self, workers=2, max_results=100, result_timeout=300):
+        self.workers = workers
+        self.result_timeout = result_timeout
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.active = {}
+        self.finished = LRUCache(max_results)
+        self.threads = []
+
+    def submit(self, id, func):
+        """
+        Returns the job for ``id``. ``func`` is only queued if no job with
+        that id is queued, running or recently finished; a failed job is
+        returned and forgotten
+        """
+        with self.lock:
+            job = self.get(id)
+            if job is not None:
+                if job.state == FAILED:
+                    self.finished.delete(id)
+                return job
+            job = Job(id, func)
+            self.active[id] = job
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        self.queue.put(job)
+        return job
+
+    def get(self, id):
+        return self.active.get(id) or self.finished.get(id)
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            job.run()
+            with self.lock:
+                del self.active[job.id]
+                self.finished.set(job.id, job, self.result_timeout)
+
+
+_queue = None
+
+def get_queue():
+    global _queue
+    if _queue is None:
+        _queue = JobQueue(getattr(settings, 'REPORTING_WORKERS', 2),
+                          getattr(settings, 'REPORTING_JOB_MAX_RESULTS', 100),
+                          getattr(settings, 'REPORTING_JOB_RESULT_TIMEOUT', 300))
+    return _queue
+
+def submit_report(report):
+    "Computes the results of ``report`` in the background, returns the job"
+    klass, request = report.__class__, report.request
+    def compute():
+        report = klass(request, load=False)
+        guards.limited(report, report.load)
+        return report.get_state()
+    return get_queue().submit(report.get_job_id(), compute)
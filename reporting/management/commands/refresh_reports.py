@@ -0,0 +1,33 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+import reporting
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--incremental', action='store_true', dest='incremental', default=False,
+            help='Only recompute groups changed since the previous refresh.'),
+    )
+    help = 'Refreshes materialized summaries of reports with materialize = True.'
+    args = '[slug ...]'
+
+    def handle(self, *slugs, **options):
+        from reporting import materialize
+        reporting.autodiscover()
+        if slugs:
+            reports = [(slug, reporting.get_report(slug)) for slug in slugs]
+            for slug, klass in reports:
+                if not klass.materialize:
+                    raise CommandError("Report '%s' is not materialized" % slug)
+        else:
+            reports = [(slug, klass) for slug, klass in reporting.all_reports()
+                       if klass.materialize]
+        for slug, klass in reports:
+            try:
+                materialize.refresh(klass, incremental=options['incremental'])
+            except ValueError, e:
+                raise CommandError(str(e))
+            if int(options.get('verbosity', 1)) > 0:
+                print "Refreshed %s" % slug
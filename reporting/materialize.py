@@ -0,0 +1,554 @@
+"""
+Materialized report summaries. Reports with ``materialize = True`` get their
+annotate rows and aggregation precomputed for every group by option and
+every combination of exact values of ``materialize_filters`` (defaults to
+``list_filter``). Report.get_results reads them instead of running the
+annotate query whenever the request params are covered.
+
+With ``materialize_incremental = True`` the snapshots are also kept up to
+date from save and delete signals of the report model, in the transaction
+of the change when there is one. Each change reads and locks the snapshots
+it touches with one query per group by option, and only writes the rows of
+the groups it changes.
+
+Snapshots store one ReportSnapshotRow per group, serialized as JSON, with
+its group value and annotate columns in sortable form so that ordering and
+pagination of the rows run in the database.
+"""
+import datetime
+from decimal import Decimal
+from itertools import combinations
+
+from django.db import connection, transaction
+from django.db.models import Min, Sum, Count, Avg
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.db.models.fields.related import RelatedField
+from django.http import HttpRequest
+from django.utils import simplejson
+from django.utils.datastructures import SortedDict
+from django.utils.hashcompat import md5_constructor
+
+from reporting import db, timeseries
+from reporting.base import in_lookup, lookup_value
+from reporting.guards import get_engine
+from reporting.models import ReportSnapshot, ReportSnapshotRow, ReportSnapshotValue
+from reporting.timeseries import avg_parts
+
+
+def encode(value):
+    "JSON form of the values of rows that simplejson does not handle"
+    if isinstance(value, Decimal):
+        return {'__decimal__': str(value)}
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': [value.year, value.month, value.day, value.hour,
+                                 value.minute, value.second, value.microsecond]}
+    if isinstance(value, datetime.date):
+        return {'__date__': [value.year, value.month, value.day]}
+    if isinstance(value, datetime.time):
+        return {'__time__': [value.hour, value.minute, value.second, value.microsecond]}
+    raise TypeError('%r is not JSON serializable' % value)
+
+def decode(obj):
+    if len(obj) == 1:
+        name, value = obj.items()[0]
+        if name == '__decimal__':
+            return Decimal(value)
+        if name == '__datetime__':
+            return datetime.datetime(*value)
+        if name == '__date__':
+            return datetime.date(*value)
+        if name == '__time__':
+            return datetime.time(*value)
+    return obj
+
+def dumps(data):
+    return simplejson.dumps(data, default=encode, separators=(',', ':'))
+
+def loads(data):
+    return simplejson.loads(data, object_hook=decode)
+
+def group_key(value):
+    "Serialized group value, the same for values the database groups together"
+    if isinstance(value, bool):
+        value = int(value)
+    elif isinstance(value, Decimal):
+        value = value.normalize()
+    return dumps(value)
+
+def sort_columns(value):
+    "(number, text) pair ordering ``value`` among the values of its column"
+    if value is None:
+        return None, None
+    if isinstance(value, (bool, int, long, float, Decimal)):
+        return float(value), None
+    if isinstance(value, (datetime.date, datetime.time)):
+        return None, value.isoformat()
+    return None, unicode(value)
+
+def filter_key(filters):
+    "``filters`` is a sequence of (field, unicode value) pairs"
+    return md5_constructor(dumps(sorted(filters))).hexdigest()
+
+def param_value(value):
+    "The query string form of a filter value"
+    if value is True:
+        return u'1'
+    if value is False:
+        return u'0'
+    if value is None:
+        return None
+    return unicode(value)
+
+def get_filter_fields(report):
+    return list(report.materialize_filters or report.list_filter or [])
+
+
+def get_snapshot_filters(report):
+    """
+    Maps the lookup params of ``report`` to (field, value) pairs of
+    materialized filters, None if some param is not an exact match on one
+    """
+    fields = get_filter_fields(report)
+    filters = []
+    for key, value in report.lookup_params.items():
+        name = key
+        if name.endswith('__exact'):
+            name = name[:-len('__exact')]
+        for field_name in fields:
+            try:
+                field = report.get_field(field_name)
+            except FieldDoesNotExist:
+                continue
+            if isinstance(field, RelatedField) and \
+                    name == '%s__%s' % (field_name, field.rel.to._meta.pk.name):
+                name = field_name
+        if name not in fields or not isinstance(value, basestring):
+            return None
+        filters.append((name, value))
+    return filters
+
+def get_snapshot(report):
+    "Returns (rows, aggregation data) for the report's params, None if not materialized"
+    filters = get_snapshot_filters(report)
+    if filters is None:
+        return None
+    try:
+        snapshot = ReportSnapshot.objects.get(slug=report.get_slug(),
+                                              group_by=report.selected_group_by,
+                                              filter_key=filter_key(filters))
+    except ReportSnapshot.DoesNotExist:
+        return None
+    return (SnapshotRows(report.selected_group_by, snapshot.rows.all()),
+            loads(snapshot.aggregation))
+
+
+class SnapshotRows(object):
+    """
+    The rows of a snapshot as the annotated queryset of the report returns
+    them: order_by(), count() and slicing run in the database
+    """
+    def __init__(self, group_by, queryset):
+        self.group_by = group_by
+        self.queryset = queryset
+    
+    def order_by(self, *ordering):
+        qs = self.queryset
+        order = []
+        for name in ordering:
+            prefix, field = '', name
+            if name.startswith('-'):
+                prefix, field = '-', name[1:]
+            if field == self.group_by:
+                order.extend([prefix + 'number', prefix + 'text'])
+                continue
+            select = SortedDict()
+            for column in ('number', 'text'):
+                alias = 'reporting_%s_%d' % (column, len(order))
+                select[alias] = column_sql(column)
+                order.append(prefix + alias)
+            qs = qs.extra(select=select, select_params=(field, field))
+        return SnapshotRows(self.group_by, qs.order_by(*order))
+    
+    def count(self):
+        return self.queryset.count()
+    
+    def __getitem__(self, k):
+        return SnapshotRows(self.group_by, self.queryset[k])
+    
+    def __iter__(self):
+        for row in self.queryset:
+            yield loads(row.data)
+
+def column_sql(column):
+    "Subquery selecting ``column`` of the named ReportSnapshotValue of a row"
+    qn = connection.ops.quote_name
+    opts, row_opts = ReportSnapshotValue._meta, ReportSnapshotRow._meta
+    return 'SELECT %s FROM %s WHERE %s = %s.%s AND %s = %%s' % (
+        qn(column), qn(opts.db_table), qn(opts.get_field('row').column),
+        qn(row_opts.db_table), qn(row_opts.pk.column), qn('name'))
+
+
+ROWS_COLUMN = 'reporting_rows'
+
+def get_annotate_args(report):
+    """
+    Annotations of snapshot rows: the report's own, the number of rows in
+    the group and Sum and Count parts of every Avg
+    """
+    annotate_args = timeseries.get_annotate_args(report)
+    annotate_args[ROWS_COLUMN] = Count('pk')
+    return annotate_args
+
+def compute_rows(report, fields, qs):
+    """
+    Returns {filter key: rows} for every combination of ``fields``, one
+    annotate query per subset of fields
+    """
+    group_by = report.selected_group_by
+    annotate_args = get_annotate_args(report)
+    columns = [group_by] + annotate_args.keys()
+    result = {}
+    for size in range(len(fields) + 1):
+        for subset in combinations(fields, size):
+            values = [group_by] + [f for f in subset if f != group_by]
+            for row in qs.values(*values).annotate(**annotate_args).order_by():
+                filters = [(f, param_value(row[f])) for f in subset]
+                if None in [value for f, value in filters]:
+                    continue
+                item = dict([(c, row[c]) for c in columns])
+                result.setdefault(filter_key(filters), []).append(item)
+    return result
+
+def compute_aggregations(report, fields):
+    "Returns {filter key: aggregation data}, one query per subset of fields"
+    if report.aggregate is None:
+        return {}
+    qs = report.get_queryset()
+    aggregate_args = {}
+    for field, func in report.aggregate:
+        aggregate_args[field] = func(field)
+    result = {filter_key([]): qs.aggregate(**aggregate_args)}
+    for size in range(1, len(fields) + 1):
+        for subset in combinations(fields, size):
+            for row in qs.values(*subset).annotate(**aggregate_args).order_by():
+                filters = [(f, param_value(row[f])) for f in subset]
+                data = dict([(field, row[field]) for field in aggregate_args])
+                result[filter_key(filters)] = data
+    return result
+
+
+def refresh(report_class, incremental=False):
+    """
+    Recomputes the snapshots of a report. An incremental refresh only
+    recomputes groups having rows whose ``materialize_changed_field`` is
+    newer than the previous refresh; rows deleted or moved to another group
+    are only accounted for by a full refresh
+    """
+    report = report_class(HttpRequest(), load=False)
+    slug = report.get_slug()
+    fields = get_filter_fields(report)
+    since = None
+    if incremental:
+        if not report.materialize_changed_field:
+            raise ValueError("Report '%s' has no materialize_changed_field" % slug)
+        since = ReportSnapshot.objects.filter(slug=slug).aggregate(Min('updated'))['updated__min']
+    now = datetime.datetime.now()
+    aggregations = None
+    for group_by in report.group_by:
+        report.selected_group_by = group_by
+        if aggregations is None and report.derive_aggregation([]) is None:
+            aggregations = compute_aggregations(report, fields)
+        if since is None:
+            refresh_all(report, fields, aggregations, now)
+        else:
+            refresh_changed(report, fields, aggregations, since, now)
+    ReportSnapshot.objects.filter(slug=slug).update(updated=now)
+refresh = transaction.commit_on_success(refresh)
+
+def refresh_all(report, fields, aggregations, now):
+    slug, group_by = report.get_slug(), report.selected_group_by
+    clear(slug, group_by)
+    for key, rows in compute_rows(report, fields, report.get_queryset()).items():
+        snapshot = ReportSnapshot(slug=slug, group_by=group_by, filter_key=key)
+        save(report, snapshot, rows, aggregations, now)
+        for row in rows:
+            save_row(report, snapshot, group_key(row[group_by]), row)
+
+def refresh_changed(report, fields, aggregations, since, now):
+    slug, group_by = report.get_slug(), report.selected_group_by
+    qs = report.get_queryset()
+    changed = qs.filter(**{'%s__gt' % report.materialize_changed_field: since})
+    groups = set(changed.values_list(group_by, flat=True).distinct())
+    if not groups:
+        return
+    fresh = compute_rows(report, fields, qs.filter(in_lookup(group_by, list(groups))))
+    snapshots = dict([(snapshot.filter_key, snapshot) for snapshot in
+                      ReportSnapshot.objects.filter(slug=slug, group_by=group_by)])
+    keys = [group_key(group) for group in groups]
+    stored = get_rows(snapshots.values(), keys)
+    for key in set(snapshots) | set(fresh):
+        snapshot = snapshots.get(key) or ReportSnapshot(slug=slug, group_by=group_by,
+                                                        filter_key=key)
+        rows = dict.fromkeys(keys)
+        for row in fresh.get(key, []):
+            rows[group_key(row[group_by])] = row
+        write(report, snapshot, stored.get(snapshot.pk, {}), rows, aggregations, now)
+
+def save(report, snapshot, rows, aggregations, now):
+    """
+    Saves ``snapshot`` with its aggregation, derived from ``rows``, all rows
+    of the snapshot, if ``aggregations`` is None
+    """
+    if aggregations is None:
+        data = report.derive_aggregation(rows)
+    else:
+        data = aggregations.get(snapshot.filter_key)
+    snapshot.aggregation = dumps(data)
+    snapshot.updated = now
+    snapshot.save(force_insert=snapshot.pk is None, force_update=snapshot.pk is not None)
+
+def save_row(report, snapshot, key, row, instance=None):
+    """
+    Inserts, or updates if ``instance`` is given, the snapshot row of a
+    group. Only the annotate columns whose value changed are updated
+    """
+    created = instance is None
+    if created:
+        instance, old = ReportSnapshotRow(snapshot=snapshot, key=key), {}
+    else:
+        old = loads(instance.data)
+    instance.number, instance.text = sort_columns(row[report.selected_group_by])
+    instance.data = dumps(row)
+    instance.save(force_insert=created, force_update=not created)
+    for name in set([field for field, func in report.annotate]):
+        number, text = sort_columns(row[name])
+        if created:
+            ReportSnapshotValue.objects.create(row=instance, name=name,
+                                               number=number, text=text)
+        elif sort_columns(old.get(name)) != (number, text):
+            ReportSnapshotValue.objects.filter(row=instance, name=name).update(
+                number=number, text=text)
+
+def get_rows(snapshots, keys):
+    "{snapshot pk: {group key: row}} of the groups ``keys`` of ``snapshots``, one query"
+    result = {}
+    if snapshots:
+        for row in ReportSnapshotRow.objects.filter(snapshot__in=snapshots, key__in=keys):
+            result.setdefault(row.snapshot_id, {})[row.key] = row
+    return result
+
+def write(report, snapshot, stored, rows, aggregations, now):
+    """
+    Writes ``rows``, {group key: row, None if the group has no rows}, to
+    ``snapshot`` whose current rows of these groups are ``stored`` and
+    updates its aggregation. Snapshots left without rows are deleted
+    """
+    if snapshot.pk is None:
+        rows = dict([(key, row) for key, row in rows.items()
+                     if row is not None and row[ROWS_COLUMN] > 0])
+        if rows:
+            save(report, snapshot, rows.values(), aggregations, now)
+            for key, row in rows.items():
+                save_row(report, snapshot, key, row)
+        return
+    for key, row in rows.items():
+        if row is not None and row[ROWS_COLUMN] > 0:
+            save_row(report, snapshot, key, row, stored.get(key))
+        elif key in stored:
+            stored[key].delete()
+    current = None
+    if aggregations is None:
+        current = [loads(data) for data in snapshot.rows.values_list('data', flat=True)]
+        empty = not current
+    else:
+        empty = not snapshot.rows.exists()
+    if empty:
+        snapshot.delete()
+    else:
+        save(report, snapshot, current, aggregations, now)
+
+def clear(slug, group_by):
+    "Deletes the snapshots of a group by option with their rows, without loading them"
+    qn = connection.ops.quote_name
+    snapshots = ReportSnapshot.objects.filter(slug=slug, group_by=group_by)
+    rows = ReportSnapshotRow.objects.filter(snapshot__in=snapshots)
+    cursor = connection.cursor()
+    for model, field, qs in [(ReportSnapshotValue, 'row', rows),
+                             (ReportSnapshotRow, 'snapshot', snapshots)]:
+        sql, params = db.get_sql(qs.values('pk'), None)
+        cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+            qn(model._meta.db_table), qn(model._meta.get_field(field).column), sql), params)
+    cursor.execute('DELETE FROM %s WHERE %s = %%s AND %s = %%s' % (
+        qn(ReportSnapshot._meta.db_table), qn('slug'), qn('group_by')), [slug, group_by])
+    if transaction.is_managed():
+        transaction.set_dirty()
+
+
+def is_decomposable(report):
+    for field, func in report.annotate:
+        if func not in (Sum, Count, Avg):
+            return False
+    return True
+
+def apply_delta(report, row, instance, sign):
+    "Adds (sign = 1) or removes (sign = -1) ``instance`` from a group row"
+    row[ROWS_COLUMN] += sign
+    for field, func in report.annotate:
+        value = lookup_value(instance, field)
+        if value is None:
+            continue
+        if func is Count:
+            row[field] += sign
+        elif func is Sum:
+            row[field] = (row[field] or 0) + sign * value
+        elif func is Avg:
+            sum_name, count_name = avg_parts(field)
+            row[sum_name] = (row[sum_name] or 0) + sign * value
+            row[count_name] += sign
+            row[field] = None
+            if row[count_name]:
+                row[field] = float(row[sum_name]) / row[count_name]
+
+def empty_row(report, group):
+    row = dict([(name, None) for name in get_annotate_args(report)])
+    row[report.selected_group_by] = group
+    row[ROWS_COLUMN] = 0
+    for field, func in report.annotate:
+        if func is Count:
+            row[field] = 0
+        elif func is Avg:
+            row[avg_parts(field)[1]] = 0
+    return row
+
+def compute_group_row(report, filters, group):
+    "Recomputes one group row of a filter combination with a query"
+    group_by = report.selected_group_by
+    qs = report.get_queryset().filter(**dict([(str(f), v) for f, v in filters]))
+    qs = qs.filter(in_lookup(group_by, [group]))
+    rows = list(qs.values(group_by).annotate(**get_annotate_args(report)).order_by())
+    return rows and rows[0] or None
+
+def compute_aggregation(report, filters):
+    qs = report.get_queryset().filter(**dict([(str(f), v) for f, v in filters]))
+    aggregate_args = {}
+    for field, func in report.aggregate:
+        aggregate_args[field] = func(field)
+    return qs.aggregate(**aggregate_args)
+
+def lock_snapshots(report, keys):
+    """
+    {filter key: snapshot} of the current group by option for ``keys``, read
+    with one query. On PostgreSQL and MySQL the rows stay locked until the
+    end of the transaction, so concurrent changes are applied one after the
+    other instead of overwriting each other's rows
+    """
+    qs = ReportSnapshot.objects.filter(slug=report.get_slug(), group_by=report.selected_group_by,
+                                       filter_key__in=keys).order_by('filter_key')
+    engine = get_engine(connection)
+    if 'postgresql' in engine or 'mysql' in engine:
+        sql, params = db.get_sql(qs, None)
+        qs = ReportSnapshot.objects.raw(sql + ' FOR UPDATE', params)
+    return dict([(snapshot.filter_key, snapshot) for snapshot in qs])
+
+def apply_change(report_class, changes):
+    """
+    Applies ``changes``, (instance, sign) pairs of rows of the report model
+    removed (sign = -1) or added (sign = 1), to the snapshots of every group
+    by option and filter combination they belong to. Sum, Count and Avg
+    annotations are updated in place, other functions recompute the group
+    row with a query. Group by options whose lookups can not be read from
+    the instances lose their snapshots until the next refresh
+    """
+    report = report_class(HttpRequest(), load=False)
+    fields = get_filter_fields(report)
+    decomposable = is_decomposable(report)
+    now = datetime.datetime.now()
+    for group_by in report.group_by:
+        report.selected_group_by = group_by
+        combos, deltas = {}, {}
+        try:
+            for instance, sign in changes:
+                group = lookup_value(instance, group_by)
+                values = dict([(f, param_value(lookup_value(instance, f))) for f in fields])
+                for size in range(len(fields) + 1):
+                    for subset in combinations(fields, size):
+                        filters = [(f, values[f]) for f in subset]
+                        if None in [value for f, value in filters]:
+                            continue
+                        key = filter_key(filters)
+                        combos[key] = filters
+                        deltas.setdefault(key, []).append((group, instance, sign))
+        except ValueError:
+            clear(report.get_slug(), group_by)
+            continue
+        snapshots = lock_snapshots(report, combos.keys())
+        if not snapshots:
+            continue
+        keys = set([group_key(group) for key in deltas for group, instance, sign in deltas[key]])
+        stored = get_rows(snapshots.values(), list(keys))
+        for key, filters in combos.items():
+            snapshot = snapshots.get(key)
+            if snapshot is None:
+                snapshot = ReportSnapshot(slug=report.get_slug(), group_by=group_by,
+                                          filter_key=key)
+            apply_snapshot_change(report, snapshot, filters, deltas[key],
+                                  stored.get(snapshot.pk, {}), decomposable, now)
+
+def apply_snapshot_change(report, snapshot, filters, deltas, stored, decomposable, now):
+    """
+    Applies (group, instance, sign) ``deltas`` to ``snapshot`` whose rows of
+    the changed groups are ``stored``, and saves the changed rows
+    """
+    rows = {}
+    for group, instance, sign in deltas:
+        key = group_key(group)
+        if decomposable:
+            row = rows.get(key)
+            if row is None and key in stored:
+                row = loads(stored[key].data)
+            elif row is None:
+                row = empty_row(report, group)
+            apply_delta(report, row, instance, sign)
+            rows[key] = row
+        elif key not in rows:
+            rows[key] = compute_group_row(report, filters, group)
+    aggregations = None
+    if report.aggregate is None:
+        aggregations = {}
+    elif report.derive_aggregation([]) is None:
+        aggregations = {snapshot.filter_key: compute_aggregation(report, filters)}
+    write(report, snapshot, stored, rows, aggregations, now)
+
+def in_transaction(func):
+    "Runs ``func`` in a transaction of its own unless the caller manages one"
+    def run(*args):
+        if transaction.is_managed():
+            return func(*args)
+        return transaction.commit_on_success(func)(*args)
+    return run
+apply_change = in_transaction(apply_change)
+
+
+def connect_incremental(slug, report_class):
+    "Keeps snapshots of ``report_class`` up to date as its model changes"
+    model = report_class.model
+    def remember(sender, instance, **kwargs):
+        instance._reporting_old = None
+        if instance.pk is not None:
+            try:
+                instance._reporting_old = sender._default_manager.get(pk=instance.pk)
+            except sender.DoesNotExist:
+                pass
+    def saved(sender, instance, **kwargs):
+        changes = [(instance, 1)]
+        old = getattr(instance, '_reporting_old', None)
+        if old is not None:
+            changes.insert(0, (old, -1))
+        apply_change(report_class, changes)
+    def deleted(sender, instance, **kwargs):
+        apply_change(report_class, [(instance, -1)])
+    uid = 'reporting:incremental:%s' % slug
+    pre_save.connect(remember, sender=model, weak=False, dispatch_uid=uid)
+    post_save.connect(saved, sender=model, weak=False, dispatch_uid=uid)
+    post_delete.connect(deleted, sender=model, weak=False, dispatch_uid=uid)
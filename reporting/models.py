@@ -0,0 +1,49 @@
+from django.db import models
+
+
+class ReportSnapshot(models.Model):
+    """
+    Materialized aggregation data of a report for one group by option and
+    one combination of filter values, its annotate rows are ReportSnapshotRow
+    """
+    slug = models.CharField(max_length=255)
+    group_by = models.CharField(max_length=255)
+    filter_key = models.CharField(max_length=32)
+    aggregation = models.TextField()
+    updated = models.DateTimeField()
+
+    class Meta:
+        unique_together = [('slug', 'group_by', 'filter_key')]
+
+    def __unicode__(self):
+        return u'%s by %s' % (self.slug, self.group_by)
+
+
+class ReportSnapshotRow(models.Model):
+    """
+    The annotate row of one group of a snapshot. ``key`` and ``data`` are
+    the serialized group value and row, ``number`` and ``text`` order the
+    rows by group value in the database
+    """
+    snapshot = models.ForeignKey(ReportSnapshot, related_name='rows')
+    key = models.TextField()
+    number = models.FloatField(null=True)
+    text = models.TextField(null=True)
+    data = models.TextField()
+
+    def __unicode__(self):
+        return self.key
+
+
+class ReportSnapshotValue(models.Model):
+    "An annotate column of a snapshot row, for ordering rows by it in the database"
+    row = models.ForeignKey(ReportSnapshotRow, related_name='columns')
+    name = models.CharField(max_length=255)
+    number = models.FloatField(null=True)
+    text = models.TextField(null=True)
+
+    class Meta:
+        unique_together = [('row', 'name')]
+
+    def __unicode__(self):
+        return self.name
@@ -0,0 +1,37 @@
+import sys
+import threading
+
+from reporting import db
+
+
+def run(tasks, workers):
+    """
+    Calls ``tasks``, a list of (name, callable) pairs, on up to ``workers``
+    threads and returns {name: result}. Every thread uses its own database
+    connections and closes them when done. The first exception raised by a
+    task is re-raised in the calling thread after all threads finished
+    """
+    pending = list(tasks)
+    results, errors = {}, []
+    lock = threading.Lock()
+    def work():
+        try:
+            while True:
+                with lock:
+                    if not pending or errors:
+                        return
+                    name, func = pending.pop(0)
+                try:
+                    results[name] = func()
+                except Exception:
+                    errors.append(sys.exc_info())
+        finally:
+            db.close_connections()
+    threads = [threading.Thread(target=work) for i in range(min(workers, len(pending)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
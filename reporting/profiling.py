@@ -0,0 +1,56 @@
+import logging
+import time
+
+from django.db import connection
+
+
+logger = logging.getLogger('reporting')
+
+
+class CountingCursor(object):
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def execute(self, *args, **kwargs):
+        self.counter[0] += 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self.counter[0] += 1
+        return self.cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+def record(stages, name, func, rows=None, connection=connection):
+    """
+    Calls ``func`` and appends its stage record to ``stages``. Queries are
+    counted by wrapping the cursors of ``connection`` (the current thread's
+    default connection), so nested stages are counted in their parent stage
+    too
+    """
+    counter = [0]
+    previous = connection.__dict__.get('cursor')
+    original = connection.cursor
+    connection.cursor = lambda: CountingCursor(original(), counter)
+    start = time.time()
+    try:
+        result = func()
+    finally:
+        elapsed = time.time() - start
+        if previous is None:
+            del connection.cursor
+        else:
+            connection.cursor = previous
+    if rows is not None:
+        rows = rows(result)
+    stages.append({'stage': name,
+                   'time': round(elapsed, 4),
+                   'queries': counter[0],
+                   'rows': rows})
+    return result
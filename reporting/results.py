@@ -0,0 +1,113 @@
+class ResultSet(object):
+    """
+    Group rows of a report stored by column: group by values (``keys``),
+    their labels, one list per annotate column and the details of each row.
+    Named extra columns can be added with ``add_column``. Iterating or
+    indexing yields ResultRow views, slicing returns a new ResultSet.
+    """
+    def __init__(self, width):
+        self.keys = []
+        self.labels = []
+        self.columns = [[] for i in range(width)]
+        self.details = []
+        self.details_more = []
+        self.extra = {}
+
+    def append(self, key, label, values):
+        "Appends a row and returns its index"
+        self.keys.append(key)
+        self.labels.append(label)
+        for column, value in zip(self.columns, values):
+            column.append(value)
+        self.details.append(None)
+        self.details_more.append(None)
+        for column in self.extra.values():
+            column.append(None)
+        return len(self.keys) - 1
+
+    def add_column(self, name):
+        self.extra[name] = [None] * len(self.keys)
+        return self.extra[name]
+
+    def take(self, indices):
+        "A new ResultSet holding the rows at ``indices``, in that order"
+        result = ResultSet(0)
+        result.keys = [self.keys[i] for i in indices]
+        result.labels = [self.labels[i] for i in indices]
+        result.columns = [[column[i] for i in indices] for column in self.columns]
+        result.details = [self.details[i] for i in indices]
+        result.details_more = [self.details_more[i] for i in indices]
+        for name, column in self.extra.items():
+            result.extra[name] = [column[i] for i in indices]
+        return result
+
+    def sort(self, column=None, reverse=False):
+        "Sorts rows by an annotate column index, or by label if None"
+        if column is None:
+            values = self.labels
+        else:
+            values = self.columns[column]
+        order = sorted(range(len(values)), key=values.__getitem__, reverse=reverse)
+        result = self.take(order)
+        self.__dict__.update(result.__dict__)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        for i in xrange(len(self.keys)):
+            yield ResultRow(self, i)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.take(range(*index.indices(len(self.keys))))
+        if index < 0:
+            index += len(self.keys)
+        if not 0 <= index < len(self.keys):
+            raise IndexError(index)
+        return ResultRow(self, index)
+
+
+class ResultRow(object):
+    """
+    View of one row of a ResultSet. ``values`` is the label followed by the
+    annotate values, like the dicts rows used to be; item access is kept
+    for compatibility
+    """
+    __slots__ = ('result_set', 'index')
+
+    def __init__(self, result_set, index):
+        self.result_set = result_set
+        self.index = index
+
+    def values(self):
+        row = [self.result_set.labels[self.index]]
+        row.extend([column[self.index] for column in self.result_set.columns])
+        return row
+    values = property(values)
+
+    def key(self):
+        return self.result_set.keys[self.index]
+    key = property(key)
+
+    def details(self):
+        return self.result_set.details[self.index]
+    details = property(details)
+
+    def details_more(self):
+        return self.result_set.details_more[self.index]
+    details_more = property(details_more)
+
+    def __getattr__(self, name):
+        if name in ResultRow.__slots__:
+            raise AttributeError(name)
+        try:
+            return self.result_set.extra[name][self.index]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# Sent after a report page is rendered with profiling on, ``stages`` is
+# a list of {'stage', 'time', 'queries', 'rows'} dicts
+report_profiled = Signal(providing_args=['report', 'stages'])
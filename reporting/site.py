@@ -1,22 +1,141 @@
+"""
+The report registry. Reports are registered either as classes or as dotted
+paths, which are only imported when the report is first used, so listing
+the registered reports does not import them. REPORTING_REPORTS declares
+reports for autodiscover as (slug, dotted path) or (slug, dotted path,
+verbose name) items; giving the verbose name keeps the report list from
+importing the report. The report modules autodiscover finds in installed
+apps are imported when the reports are listed, or when a report not
+registered yet is asked for.
+
+Reports with cache_invalidation or materialize_incremental connect their
+signals when their class is loaded; processes that change data without
+viewing reports should call reporting.load_all() to connect them.
+"""
+import pkgutil
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+from reporting import cache
+
+
+class ReportEntry(object):
+    "A registered report, its class is imported from ``path`` on first use"
+    def __init__(self, site, slug, path=None, klass=None, verbose_name=None):
+        self.site = site
+        self.slug = slug
+        self.path = path
+        self.klass = klass
+        self._verbose_name = verbose_name
+
+    def loaded(self):
+        return self.klass is not None
+    loaded = property(loaded)
+
+    def get_class(self):
+        if self.klass is None:
+            with self.site._lock:
+                if self.klass is None:
+                    module, attr = self.path.rsplit('.', 1)
+                    klass = getattr(import_module(module), attr)
+                    self.site.prepare(self.slug, klass)
+                    self.klass = klass
+        return self.klass
+
+    def verbose_name(self):
+        return self._verbose_name or self.get_class().verbose_name
+    verbose_name = property(verbose_name)
 
 
 class ReportingSite(object):
-    _registry = {}
-    
-    
-    def register(self, slug, klass):
-        self._registry[slug] = klass
-        print self, self._registry
-    
-    def get_report(self, slug):
+    def __init__(self):
+        self._registry = OrderedDict()
+        self._modules = []
+        self._discovered = False
+        self._lock = threading.RLock()
+
+    def register(self, slug, klass, verbose_name=None):
+        """
+        Registers a Report subclass, or a dotted path to one which is
+        imported when the report is first used
+        """
+        if isinstance(klass, basestring):
+            entry = ReportEntry(self, slug, path=klass, verbose_name=verbose_name)
+        else:
+            self.prepare(slug, klass)
+            entry = ReportEntry(self, slug, klass=klass, verbose_name=verbose_name)
+        self._registry[slug] = entry
+
+    def prepare(self, slug, klass):
+        """
+        Validates and compiles ``klass`` (see Report.get_spec), connects its
+        signals. The slug the class declares itself, if any, keys its cache,
+        snapshots and signals; an inherited one does not
+        """
+        if klass.__dict__.get('slug') is None:
+            klass.slug = slug
+        slug = klass.slug
+        klass.get_spec()
+        if klass.cache_invalidation:
+            cache.connect_invalidation(slug, klass.get_cache_models())
+        if klass.materialize_incremental:
+            from reporting import materialize
+            materialize.connect_incremental(slug, klass)
+
+    def autodiscover(self):
+        """
+        Registers the reports of REPORTING_REPORTS and finds the
+        REPORTING_SOURCE_FILE modules of installed apps without importing
+        them. They are imported when a report not registered yet is asked for
+        """
+        if self._discovered:
+            return
+        self._discovered = True
+        for item in getattr(settings, 'REPORTING_REPORTS', ()):
+            self.register(*item)
+        source = getattr(settings, 'REPORTING_SOURCE_FILE', 'reports')
+        for app in settings.INSTALLED_APPS:
+            name = '%s.%s' % (app, source)
+            if pkgutil.find_loader(name) is not None:
+                self._modules.append(name)
+
+    def load_modules(self):
+        "Imports the discovered report modules, which register their reports"
+        with self._lock:
+            while self._modules:
+                # dropped once imported, a failed import is retried next time
+                import_module(self._modules[0])
+                self._modules.pop(0)
+
+    def get_entry(self, slug):
+        if slug not in self._registry:
+            self.load_modules()
         try:
             return self._registry[slug]
         except KeyError:
             raise Exception("No such report '%s'" % slug)
-    
-    def all_reports(self):
-        print self, self._registry
+
+    def get_report(self, slug):
+        return self.get_entry(slug).get_class()
+
+    def entries(self):
+        """
+        [(slug, ReportEntry)] of the registered reports, importing the
+        discovered report modules. Reports declared by path with a verbose
+        name are not imported
+        """
+        self.load_modules()
         return self._registry.items()
 
+    def all_reports(self):
+        "[(slug, report class)] of all reports, importing them"
+        return [(slug, self.get_report(slug)) for slug, entry in self.entries()]
+
+    def load_all(self):
+        self.all_reports()
+
 
-site = ReportingSite()
\ No newline at end of file
+site = ReportingSite()
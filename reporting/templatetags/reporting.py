@@ -1,3 +1,4 @@
+from __future__ import absolute_import
 from django.db.models.fields.related import RelatedField
 from django.db.models.fields import DateField
 import datetime
@@ -5,6 +6,8 @@ from django.utils.translation import get_date_formats, get_partial_date_formats,
 from django.utils import dateformat
 from django.utils.safestring import mark_safe
 from django.template import Library
+from reporting import db
+from reporting.timeseries import to_date
 
 register = Library()
 
@@ -22,10 +25,30 @@ def get_date_model_field(model, lookup):
     return get_date_model_field(rel_model, next_lookup)
 
 
+def date_buckets(cl, model, field_name, kind):
+    """
+    Returns [(date, count)] for the report's filtered queryset truncated to
+    ``kind`` ('year', 'month' or 'day'), computed in one grouped query
+    """
+    lookup = cl.date_hierarchy
+    qs = cl.get_queryset().filter(**{'%s__isnull' % lookup: False}).order_by()
+    sql, params = db.get_sql(qs.values_list(lookup), cl.database)
+    connection = db.get_connection(cl.database)
+    column = 'U0.%s' % connection.ops.quote_name(model._meta.get_field(field_name).column)
+    trunc = connection.ops.date_trunc_sql(kind, column)
+    cursor = connection.cursor()
+    cursor.execute('SELECT %s, COUNT(*) FROM (%s) U0 GROUP BY 1 ORDER BY 1' % (trunc, sql),
+                   params)
+    return [(to_date(value), count) for value, count in cursor.fetchall()]
+
+
 def report_date_hierarchy(cl):
+    if cl.date_hierarchy:
+        return cl.get_date_hierarchy()
+
+def date_hierarchy_choices(cl):
     if cl.date_hierarchy:
         model, field_name = get_date_model_field(cl.model, cl.date_hierarchy)
-        rel_query_set = model.objects.all()
          
         year_field = '%s__year' % cl.date_hierarchy
         month_field = '%s__month' % cl.date_hierarchy
@@ -49,7 +72,7 @@ def report_date_hierarchy(cl):
                 'choices': [{'title': dateformat.format(day, month_day_format)}]
             }
         elif year_lookup and month_lookup:
-            days = rel_query_set.filter(**{'%s__year' % field_name: year_lookup, '%s__month' % field_name: month_lookup}).dates(field_name, 'day')
+            days = date_buckets(cl, model, field_name, 'day')
             return {
                 'show': True,
                 'back': {
@@ -58,11 +81,11 @@ def report_date_hierarchy(cl):
                 },
                 'choices': [{
                     'link': link({year_field: year_lookup, month_field: month_lookup, day_field: day.day}),
-                    'title': dateformat.format(day, month_day_format)
-                } for day in days]
+                    'title': '%s (%s)' % (dateformat.format(day, month_day_format), count)
+                } for day, count in days]
             }
         elif year_lookup:
-            months = rel_query_set.filter(**{'%s__year' % field_name: year_lookup}).dates(field_name, 'month')
+            months = date_buckets(cl, model, field_name, 'month')
             return {
                 'show' : True,
                 'back': {
@@ -71,16 +94,16 @@ def report_date_hierarchy(cl):
                 },
                 'choices': [{
                     'link': link({year_field: year_lookup, month_field: month.month}),
-                    'title': dateformat.format(month, year_month_format)
-                } for month in months]
+                    'title': '%s (%s)' % (dateformat.format(month, year_month_format), count)
+                } for month, count in months]
             }
         else:
-            years = rel_query_set.dates(field_name, 'year')
+            years = date_buckets(cl, model, field_name, 'year')
             return {
                 'show': True,
                 'choices': [{
                     'link': link({year_field: year.year}),
-                    'title': year.year
-                } for year in years]
+                    'title': '%s (%s)' % (year.year, count)
+                } for year, count in years]
             }
 report_date_hierarchy = register.inclusion_tag('admin/date_hierarchy.html')(report_date_hierarchy)
\ No newline at end of file
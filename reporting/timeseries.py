@@ -0,0 +1,166 @@
+"""
+Time series reports: rows grouped by the report's ``date_hierarchy`` field
+truncated to a year, quarter, month, week or day, selected with a group by
+param like ``hire_date:month``. Buckets are computed by the database in one
+grouped query, buckets without rows are filled in here.
+"""
+import datetime
+
+from django.conf import settings
+from django.contrib.admin.options import IncorrectLookupParameters
+from reporting import db
+from django.db.backends.util import typecast_timestamp
+from django.db.models import Sum, Count, Min, Max, Avg
+from django.utils import dateformat
+from django.utils.translation import get_date_formats, get_partial_date_formats
+
+
+KINDS = ('year', 'quarter', 'month', 'week', 'day')
+BUCKET_COLUMN = 'reporting_bucket'
+
+
+def native_kinds(connection):
+    "Kinds date_trunc_sql supports on the database of ``connection``"
+    engine = getattr(connection, 'settings_dict', {}).get('ENGINE') or settings.DATABASE_ENGINE
+    if 'postgresql' in engine:
+        return KINDS
+    return ('year', 'month', 'day')
+
+def to_date(value):
+    "A date truncated by the database, which may return a string or a datetime"
+    if isinstance(value, basestring):
+        value = typecast_timestamp(str(value))
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    return value
+
+def bucket_start(date, kind):
+    "First day of the ``kind`` bucket ``date`` falls in"
+    if kind == 'year':
+        return datetime.date(date.year, 1, 1)
+    if kind == 'quarter':
+        return datetime.date(date.year, (date.month - 1) // 3 * 3 + 1, 1)
+    if kind == 'month':
+        return datetime.date(date.year, date.month, 1)
+    if kind == 'week':
+        return date - datetime.timedelta(days=date.weekday())
+    return date
+
+def next_bucket(date, kind):
+    "Start of the bucket following the one starting at ``date``"
+    if kind == 'year':
+        return datetime.date(date.year + 1, 1, 1)
+    if kind in ('quarter', 'month'):
+        month = date.month + (kind == 'quarter' and 3 or 1)
+        return datetime.date(date.year + (month - 1) // 12, (month - 1) % 12 + 1, 1)
+    if kind == 'week':
+        return date + datetime.timedelta(days=7)
+    return date + datetime.timedelta(days=1)
+
+def label(date, kind):
+    date_format = get_date_formats()[0]
+    year_month_format = get_partial_date_formats()[0]
+    if kind == 'year':
+        return unicode(date.year)
+    if kind == 'quarter':
+        return u'%s Q%s' % (date.year, (date.month - 1) // 3 + 1)
+    if kind == 'month':
+        return dateformat.format(date, year_month_format)
+    if kind == 'week':
+        return u'Week of %s' % dateformat.format(date, date_format)
+    return dateformat.format(date, date_format)
+
+
+def avg_parts(field):
+    "Names of the hidden Sum and Count columns kept for Avg annotations"
+    return 'reporting_sum_%s' % field, 'reporting_count_%s' % field
+
+def get_annotate_args(report):
+    "Annotations of ``report`` with the Sum and Count parts of every Avg"
+    annotate_args = {}
+    for field, func in report.annotate:
+        annotate_args[field] = func(field)
+        if func is Avg:
+            sum_name, count_name = avg_parts(field)
+            annotate_args[sum_name] = Sum(field)
+            annotate_args[count_name] = Count(field)
+    return annotate_args
+
+def rollup(func, total, value):
+    "Combines a subtotal with a group value of annotation ``func``"
+    if func not in (Sum, Count, Min, Max) or value is None:
+        return total
+    if total is None:
+        return value
+    if func is Min:
+        return min(total, value)
+    if func is Max:
+        return max(total, value)
+    return total + value
+
+def check_kind(report, kind):
+    """
+    Raises IncorrectLookupParameters if the database can not truncate to
+    ``kind`` and the annotations can not be combined from smaller buckets
+    """
+    if kind in native_kinds(db.get_connection(report.database)):
+        return
+    for field, func in report.annotate:
+        if func not in (Sum, Count, Min, Max, Avg):
+            raise IncorrectLookupParameters("'%s' can not be grouped by %s on this database"
+                                            % (field, kind))
+
+def get_rows(report, kind):
+    """
+    Returns [(bucket start, {annotate field: value})] for every bucket from
+    the first to the last date of the report, empty buckets included with
+    zero Sum and Count. Kinds the database can not truncate to are combined
+    from month or day buckets, see check_kind
+    """
+    connection = db.get_connection(report.database)
+    db_kind = kind
+    if kind not in native_kinds(connection):
+        db_kind = {'quarter': 'month', 'week': 'day'}[kind]
+    qn = connection.ops.quote_name
+    field = report.get_field(report.date_hierarchy)
+    column = '%s.%s' % (qn(report.model._meta.db_table), qn(field.column))
+    annotate_args = get_annotate_args(report)
+    qs = report.get_queryset().filter(**{'%s__isnull' % report.date_hierarchy: False})
+    qs = qs.extra(select={BUCKET_COLUMN: connection.ops.date_trunc_sql(db_kind, column)})
+    rows = qs.values(BUCKET_COLUMN).annotate(**annotate_args).order_by(BUCKET_COLUMN)
+
+    buckets = {}
+    for row in rows:
+        date = bucket_start(to_date(row[BUCKET_COLUMN]), kind)
+        if date in buckets:
+            merge(report, buckets[date], row)
+        else:
+            buckets[date] = row
+    return fill_gaps(report, buckets, kind)
+
+def merge(report, total, row):
+    "Adds ``row`` to ``total``, both rows of the same bucket"
+    for field, func in report.annotate:
+        if func is Avg:
+            sum_name, count_name = avg_parts(field)
+            total[sum_name] = rollup(Sum, total[sum_name], row[sum_name])
+            total[count_name] = rollup(Count, total[count_name], row[count_name])
+            if total[count_name]:
+                total[field] = float(total[sum_name]) / total[count_name]
+        else:
+            total[field] = rollup(func, total[field], row[field])
+
+def fill_gaps(report, buckets, kind):
+    if not buckets:
+        return []
+    empty = {}
+    for field, func in report.annotate:
+        empty[field] = None
+        if func in (Sum, Count):
+            empty[field] = 0
+    result = []
+    date, last = min(buckets), max(buckets)
+    while date <= last:
+        result.append((date, buckets.get(date, empty)))
+        date = next_bucket(date, kind)
+    return result
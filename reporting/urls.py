@@ -2,5 +2,7 @@ from django.conf.urls.defaults import *
 
 urlpatterns = patterns('reporting.views',
     url('^$', 'report_list', name='reporting-list'),
+    url('^jobs/(?P<job_id>\w+)/$', 'job_status', name='reporting-job'),
+    url('^(?P<slug>.*)/export/(?P<format>csv|jsonl)/$', 'export_report', name='reporting-export'),
     url('^(?P<slug>.*)/$', 'view_report', name='reporting-view'),
 )
\ No newline at end of file
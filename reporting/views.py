@@ -1,14 +1,95 @@
 from django.shortcuts import render_to_response
+from django.template import Context
 from django.template.context import RequestContext
+from django.template.loader import get_template, render_to_string
+from django.http import HttpResponse, HttpResponseBadRequest, Http404
+from django.utils import simplejson
+from django.contrib.admin.options import IncorrectLookupParameters
 import reporting
+from reporting.export import EXPORTS, get_chunk_size, iter_result_sets
+from reporting import guards, jobs
 
 def report_list(request):
-    reports = reporting.all_reports()
+    reports = reporting.get_entries()
     return render_to_response('reporting/list.html', {'reports': reports}, 
                               context_instance=RequestContext(request))
 
 def view_report(request, slug):
-    report = reporting.get_report(slug)(request)
-    data = {'report': report, 'title':report.verbose_name}
-    return render_to_response('reporting/view.html', data, 
-                              context_instance=RequestContext(request))
\ No newline at end of file
+    klass = reporting.get_report(slug)
+    try:
+        report = klass(request, load=False)
+        guards.check_cost(report)
+    except IncorrectLookupParameters, e:
+        return HttpResponseBadRequest(str(e))
+    if klass.stream and not report.nested:
+        return HttpResponse(guards.limited_iter(report, stream_report(request, report)))
+    if klass.background:
+        job = jobs.submit_report(report)
+        if job.state == jobs.FAILED:
+            if isinstance(job.error, IncorrectLookupParameters):
+                return HttpResponseBadRequest(str(job.error))
+            raise job.error
+        if job.state != jobs.DONE:
+            data = {'report': report, 'job': job, 'title': report.verbose_name}
+            return render_to_response('reporting/pending.html', data,
+                                      context_instance=RequestContext(request))
+        report.set_state(job.result)
+    def render():
+        if not klass.background:
+            report.load()
+        data = {'report': report, 'title':report.verbose_name}
+        return report.timed('render', lambda: render_to_response('reporting/view.html', data, 
+                            context_instance=RequestContext(request)))
+    try:
+        response = guards.limited(report, render)
+    except IncorrectLookupParameters, e:
+        return HttpResponseBadRequest(str(e))
+    report.publish_stages()
+    return response
+
+STREAM_MARKER = '<!-- reporting:rows -->'
+
+def stream_report(request, report):
+    """
+    Yields the report page piece by piece: the page up to the table rows,
+    the rows rendered in chunks as they are read from the database, each
+    result with a single query (see export.chunked), then the rest of the
+    page. Groups are not paginated in this mode
+    """
+    data = {'report': report, 'title': report.verbose_name,
+            'stream_marker': STREAM_MARKER}
+    page = render_to_string('reporting/view.html', data,
+                            context_instance=RequestContext(request))
+    head, tail = page.split(STREAM_MARKER)
+    yield head
+    rows = get_template('reporting/rows.html')
+    # an even chunk size keeps the row colors alternating across chunks
+    size = max(2, get_chunk_size() // 2 * 2)
+    for results in iter_result_sets(report, size):
+        yield rows.render(Context({'report': report, 'rows': results}))
+    yield tail
+    report.publish_stages()
+
+def export_report(request, slug, format):
+    try:
+        export, mimetype = EXPORTS[format]
+    except KeyError:
+        raise Http404
+    try:
+        report = reporting.get_report(slug)(request, load=False)
+        guards.check_cost(report)
+    except IncorrectLookupParameters, e:
+        return HttpResponseBadRequest(str(e))
+    if report.nested:
+        return HttpResponseBadRequest("Reports grouped by several fields can not be exported")
+    details = bool(report.detail_list_display and report.show_details)
+    response = HttpResponse(guards.limited_iter(report, export(report, details)),
+                            mimetype=mimetype)
+    response['Content-Disposition'] = 'attachment; filename=%s.%s' % (slug, format)
+    return response
+
+def job_status(request, job_id):
+    job = jobs.get_queue().get(job_id)
+    if job is None:
+        raise Http404
+    return HttpResponse(simplejson.dumps(job.as_dict()), mimetype='application/json')
@@ -0,0 +1,159 @@
+"""
+Synthetic data and timing cases for benchmarking the reporting engine on
+the people example. Used by the reporting_benchmark command.
+"""
+import cPickle as pickle
+import datetime
+import os
+import random
+import resource
+import traceback
+from decimal import Decimal
+
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.http import HttpRequest, QueryDict
+from django.utils.http import urlencode
+
+from reporting import profiling
+from reporting.base import GROUP_BY_VAR, SORT_VAR, SORTTYPE_VAR, DETAILS_SWITCH_VAR, LIMIT_VAR
+from locations.models import Country
+from models import Department, Occupation, Person
+
+
+def insert(model, fields, rows, chunk_size=10000):
+    "Inserts ``rows`` (an iterable of tuples) with executemany, chunk by chunk"
+    qn = connection.ops.quote_name
+    columns = [qn(model._meta.get_field(f).column) for f in fields]
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (qn(model._meta.db_table), ', '.join(columns),
+                                               ', '.join(['%s'] * len(columns)))
+    cursor = connection.cursor()
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            cursor.executemany(sql, chunk)
+            chunk = []
+    if chunk:
+        cursor.executemany(sql, chunk)
+
+def generate(people, seed=0):
+    """
+    Replaces all people data with ``people`` random persons, one department
+    per 100 of them, 50 occupations and 100 countries
+    """
+    rnd = random.Random(seed)
+    departments = max(1, people // 100)
+    occupations, countries = 50, 100
+    cursor = connection.cursor()
+    qn = connection.ops.quote_name
+    cursor.execute('UPDATE %s SET %s = NULL' % (qn(Department._meta.db_table),
+                                                qn(Department._meta.get_field('leader').column)))
+    for model in [Person, Department, Occupation, Country]:
+        cursor.execute('DELETE FROM %s' % qn(model._meta.db_table))
+    insert(Country, ['id', 'name'], ((i, 'Country %d' % i) for i in xrange(1, countries + 1)))
+    insert(Occupation, ['id', 'title'], ((i, 'Occupation %d' % i) for i in xrange(1, occupations + 1)))
+    insert(Department, ['id', 'title'], ((i, 'Department %d' % i) for i in xrange(1, departments + 1)))
+    start = datetime.date(1950, 1, 1)
+    insert(Person, ['id', 'name', 'occupation', 'department', 'country', 'birth_date',
+                    'salary', 'expenses'],
+           ((i, 'Person %d' % i,
+             rnd.randint(1, occupations), rnd.randint(1, departments), rnd.randint(1, countries),
+             start + datetime.timedelta(days=rnd.randint(0, 20000)),
+             Decimal(rnd.randint(100000, 1000000)) / 100, Decimal(rnd.randint(0, 100000)) / 100)
+            for i in xrange(1, people + 1)))
+    cursor.executemany('UPDATE %s SET %s = %%s WHERE %s = %%s' % (
+                           qn(Department._meta.db_table),
+                           qn(Department._meta.get_field('leader').column), qn('id')),
+                       [(rnd.randint(1, people), i) for i in xrange(1, departments + 1)])
+    for sql in connection.ops.sequence_reset_sql(no_style(), [Country, Occupation, Department, Person]):
+        cursor.execute(sql)
+    # raw cursors do not mark the transaction as dirty, it would not be committed
+    transaction.set_dirty()
+generate = transaction.commit_on_success(generate)
+
+
+def get_cases(report_class):
+    "(name, params, extra callable run on the constructed report) triples"
+    group_by = [isinstance(g, (list, tuple)) and g[0] or g for g in report_class.group_by]
+    cases = [('default', {}, None)]
+    for field in group_by:
+        cases.append(('group by %s' % field, {GROUP_BY_VAR: field}, None))
+    for field in group_by:
+        cases.append(('details by %s' % field, {GROUP_BY_VAR: field, DETAILS_SWITCH_VAR: 'y'}, None))
+    cases.append(('sorted by column 1 desc', {SORT_VAR: '1', SORTTYPE_VAR: 'desc'}, None))
+    cases.append(('first page of 50', {LIMIT_VAR: '50'}, None))
+    cases.append(('filter choices', {}, lambda report: [list(spec.choices(report))
+                                                       for spec in report.filter_specs]))
+    if report_class.date_hierarchy:
+        cases.append(('date hierarchy', {}, lambda report: report.get_date_hierarchy()))
+    return cases
+
+def peak_memory():
+    "Peak resident set size of the process in kilobytes (Linux)"
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def current_memory():
+    "Resident set size of the process in kilobytes (Linux)"
+    pages = int(open('/proc/self/statm').read().split()[1])
+    return pages * resource.getpagesize() // 1024
+
+def in_child(func):
+    """
+    Returns the result of ``func`` run in a forked process, and how much
+    that process grew its peak memory. A child starts with the memory of
+    the parent as its peak, so every case is measured on its own instead
+    of against the high-water mark of all the previous ones (Linux)
+    """
+    connection.close()
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        try:
+            try:
+                connection.cursor()
+                memory = current_memory()
+                data = (func(), peak_memory() - memory), None
+            except Exception:
+                data = None, traceback.format_exc()
+            out = os.fdopen(write, 'wb')
+            pickle.dump(data, out, pickle.HIGHEST_PROTOCOL)
+            out.close()
+            connection.close()
+        finally:
+            os._exit(0)
+    os.close(write)
+    src = os.fdopen(read, 'rb')
+    try:
+        result, error = pickle.load(src)
+    finally:
+        src.close()
+        os.waitpid(pid, 0)
+    if error is not None:
+        raise Exception('Benchmark case failed:\n%s' % error)
+    return result
+
+def run_case(report_class, params, extra=None, repeat=1):
+    """
+    Constructs the report ``repeat`` times in a forked process and returns
+    the stages of the fastest run, with 'total' first, and the growth of
+    peak memory of the case
+    """
+    def runs():
+        best = None
+        for i in range(repeat):
+            request = HttpRequest()
+            request.GET = QueryDict(urlencode(params))
+            stages = []
+            def construct():
+                report = report_class(request)
+                if extra is not None:
+                    extra(report)
+                return report
+            report = profiling.record(stages, 'total', construct, lambda r: len(r.results))
+            stages.extend(report.stages)
+            if best is None or stages[0]['time'] < best[0]['time']:
+                best = stages
+        return best
+    return in_child(runs)
@@ -0,0 +1,44 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+import reporting
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--generate', type='int', dest='generate', default=0,
+            help='Replace people data with this many generated persons first.'),
+        make_option('--seed', type='int', dest='seed', default=0,
+            help='Random seed of the generated data.'),
+        make_option('--repeat', type='int', dest='repeat', default=3,
+            help='Runs per case, the fastest one is reported.'),
+        make_option('--details-limit', type='int', dest='details_limit', default=10,
+            help='details_limit used for the details cases.'),
+    )
+    help = 'Times the people report on generated data: time, queries, rows and peak memory per case.'
+    args = '[slug]'
+
+    def handle(self, slug='people', **options):
+        from people import benchmark
+        reporting.autodiscover()
+        # measure the database, not the caches
+        settings.REPORTING_PROFILE = True
+        settings.REPORTING_CACHE_TIMEOUT = 0
+        if options['generate']:
+            benchmark.generate(options['generate'], options['seed'])
+            print 'Generated %d persons' % options['generate']
+        report_class = reporting.get_report(slug)
+        report_class.details_limit = options['details_limit']
+        verbose = int(options.get('verbosity', 1)) > 1
+        print '%-32s %10s %8s %8s %12s' % ('case', 'time (s)', 'queries', 'rows', 'peak +KB')
+        for name, params, extra in benchmark.get_cases(report_class):
+            stages, memory = benchmark.run_case(report_class, params, extra, options['repeat'])
+            total = stages[0]
+            print '%-32s %10.4f %8d %8s %12d' % (name, total['time'], total['queries'],
+                                                total['rows'], memory)
+            if verbose:
+                for stage in stages[1:]:
+                    print '    %-28s %10.4f %8d %8s' % (stage['stage'], stage['time'],
+                                                       stage['queries'], stage['rows'])
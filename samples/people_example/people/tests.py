@@ -0,0 +1,397 @@
+import datetime
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Avg, Count, Max, Min, Sum
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.http import HttpRequest
+from django.test import TestCase
+
+import reporting
+from reporting import db, guards, jobs, materialize, parallel, timeseries
+from reporting.models import ReportSnapshot
+from reporting.site import ReportingSite
+
+from locations.models import Country
+from people.models import Department, Occupation, Person
+
+
+class PersonReportTest(TestCase):
+    "Smoke tests of the sample report, loaded from initial_data"
+
+    def setUp(self):
+        reporting.autodiscover()
+
+    def test_list(self):
+        response = self.client.get('/reporting/')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Person Report')
+
+    def test_view(self):
+        response = self.client.get('/reporting/people/')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Salary Sum')
+
+    def test_view_details_and_nested(self):
+        response = self.client.get('/reporting/people/', {'ds': 'y'})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get('/reporting/people/', {'gruop_by_': 'department,occupation'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_export(self):
+        response = self.client.get('/reporting/people/export/csv/')
+        self.assertEqual(response.status_code, 200)
+        lines = ''.join(response).splitlines()
+        self.assertEqual(len(lines), 1 + reporting.get_report('people').model.objects
+                         .values('department').distinct().count())
+
+    def test_nested_export(self):
+        response = self.client.get('/reporting/people/', {'gruop_by_': 'department,occupation'})
+        self.assertContains(self.client.get('/reporting/people/'), '/export/')
+        self.assertNotContains(response, '/export/')
+        response = self.client.get('/reporting/people/export/csv/',
+                                   {'gruop_by_': 'department,occupation'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_filters_read_report_database(self):
+        report = reporting.get_report('people')(HttpRequest(), load=False)
+        report.database = 'replica'
+        routed = []
+        route = db.route
+        db.route = lambda queryset, alias: routed.append((queryset.model, alias)) or queryset
+        try:
+            self.assertEqual(len(report.filter_specs), 2)
+        finally:
+            db.route = route
+        self.assertEqual(sorted(routed), sorted([(Occupation, 'replica'), (Country, 'replica')]))
+
+    def test_parallel_tasks(self):
+        class ParallelReport(reporting.get_report('people')):
+            parallel_queries = 2
+            list_filter = ['occupation', 'department__title']
+        names = []
+        def run(tasks, workers):
+            names[:] = [name for name, func in tasks]
+            return dict([(name, func()) for name, func in tasks])
+        saved, parallel.run = parallel.run, run
+        try:
+            ParallelReport(HttpRequest())
+            self.failIf('aggregation' in names)
+            request = HttpRequest()
+            request.GET['gruop_by_'] = 'department,occupation'
+            report = ParallelReport(request)
+            self.failUnless('aggregation' in names)
+            self.failIf(report.filter_specs[1].loaded is None)
+        finally:
+            parallel.run = saved
+
+    def test_guards_only_on_requests(self):
+        calls = []
+        saved = guards.check_cost, guards.set_statement_timeout, guards.reset_statement_timeout
+        guards.check_cost = lambda report: calls.append('cost')
+        guards.set_statement_timeout = lambda report: calls.append('set') or 'previous'
+        guards.reset_statement_timeout = lambda report, previous: calls.append(previous)
+        try:
+            reporting.get_report('people')(HttpRequest())
+            self.assertEqual(calls, [])
+            self.client.get('/reporting/people/')
+            self.assertEqual(calls, ['cost', 'set', 'previous'])
+        finally:
+            guards.check_cost, guards.set_statement_timeout, guards.reset_statement_timeout = saved
+
+    def test_derived_aggregation(self):
+        "Footers derived from the group rows match QuerySet.aggregate()"
+        Department.objects.filter(pk=2).update(leader=None)
+        klass = reporting.get_report('people')
+        class MinReport(klass):
+            annotate = (('id', Count), ('salary', Sum), ('expenses', Min))
+            aggregate = (('id', Count), ('salary', Sum), ('expenses', Min))
+        class AvgReport(klass):
+            annotate = (('id', Count), ('salary', Sum), ('expenses', Max))
+            aggregate = (('id', Count), ('salary', Avg), ('expenses', Max))
+        for report_class in (MinReport, AvgReport):
+            aggregate_args = dict([(field, func(field))
+                                   for field, func in report_class.aggregate])
+            expected = Person.objects.aggregate(**aggregate_args)
+            for group_by in ('department', 'department__leader', 'occupation'):
+                for per_page in (None, 1):
+                    request = HttpRequest()
+                    request.GET.update({'gruop_by_': group_by, 's': '2', 'st': 'desc'})
+                    report = report_class(request, load=False)
+                    report.list_per_page = per_page
+                    report.load()
+                    self.assertEqual(report.derived_aggregation is not None, not per_page)
+                    values = [value for title, value in report.get_aggregation()]
+                    for (field, func), value in zip(report_class.aggregate, values):
+                        self.assertAlmostEqual(float(value), float(expected[field]))
+
+    def get_loaded_report(self, params, klass=None):
+        request = HttpRequest()
+        request.GET.update(params)
+        return (klass or reporting.get_report('people'))(request)
+
+    def test_details_of_instances(self):
+        "Details listing report attributes read the group value from the rows"
+        class DetailReport(reporting.get_report('people')):
+            detail_list_display = ['name', 'salary_with_expenses']
+            def salary_with_expenses(self, person):
+                return person.salary + person.expenses
+        for group_by in ('department', 'department__leader'):
+            settings.DEBUG = True
+            try:
+                connection.queries = []
+                report = self.get_loaded_report({'gruop_by_': group_by, 'ds': 'y'},
+                                                DetailReport)
+                details = [sql for sql in [q['sql'] for q in connection.queries]
+                           if sql.startswith('SELECT "people_person"."id"')
+                           and 'ORDER BY' in sql]
+                self.assertEqual(len(details), 1)
+            finally:
+                settings.DEBUG = False
+            for row, rows in zip(report.results, report.results.details):
+                people = Person.objects.filter(**{group_by: row.key})
+                self.assertEqual(sorted([str(item[1]) for item in rows]),
+                                 sorted([str(p.salary + p.expenses) for p in people]))
+
+    def test_sort_ties(self):
+        "Groups tied on the sorted column keep the order of their group key"
+        occupations = list(Occupation.objects.order_by('-pk'))
+        for ind, person in enumerate(Person.objects.all()):
+            person.occupation = occupations[ind % len(occupations)]
+            person.save()
+        counts = dict([(row['occupation'], row['n']) for row in
+                       Person.objects.values('occupation').annotate(n=Count('id'))])
+        self.failUnless(len(set(counts.values())) < len(counts))
+        expected = sorted(counts, key=lambda key: (-counts[key], key))
+        for params, window in [({}, slice(None)), ({'l': '2'}, slice(0, 2)),
+                               ({'l': '2', 'p': '1'}, slice(2, 4))]:
+            params.update({'gruop_by_': 'occupation', 's': '1', 'st': 'desc'})
+            report = self.get_loaded_report(params)
+            self.assertEqual([row.key for row in report.results], expected[window])
+
+    def test_pages(self):
+        # occupation pages in the database, department__leader sorts and
+        # pages by label after loading the rows
+        for group_by in ('occupation', 'department__leader'):
+            report = self.get_loaded_report({'gruop_by_': group_by, 'l': '0'})
+            self.assertEqual(report.list_per_page, None)
+            self.assertEqual(report.page_count(), 1)
+            everything = [row.key for row in report.results]
+            self.assertEqual(len(everything),
+                             Person.objects.values(group_by).distinct().count())
+            pages = []
+            for page in range(len(everything)):
+                report = self.get_loaded_report({'gruop_by_': group_by, 'l': '1', 'p': str(page)})
+                self.assertEqual(report.result_count, len(everything))
+                self.assertEqual(report.page_count(), len(everything))
+                pages.extend([row.key for row in report.results])
+            self.assertEqual(pages, everything)
+            report = self.get_loaded_report({'gruop_by_': group_by, 'l': '1', 'p': '50'})
+            self.assertEqual(list(report.results), [])
+            self.assertEqual(report.result_count, len(everything))
+        response = self.client.get('/reporting/people/', {'l': '1', 'p': '50'})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get('/reporting/people/', {'l': '1', 'p': '-1'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_rejected_lookup(self):
+        response = self.client.get('/reporting/people/', {'name': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_subclass_slug(self):
+        parent = reporting.get_report('people')
+        class ChildReport(parent):
+            pass
+        ReportingSite().register('people-child', ChildReport)
+        self.assertEqual(parent.slug, 'people')
+        self.assertEqual(ChildReport.slug, 'people-child')
+
+    def test_export_reads_one_query(self):
+        settings.DEBUG, settings.REPORTING_EXPORT_CHUNK_SIZE = True, 1
+        try:
+            connection.queries = []
+            ''.join(self.client.get('/reporting/people/export/csv/', {'ds': 'y'}))
+            people = [q['sql'] for q in connection.queries if 'FROM "people_person"' in q['sql']]
+            self.assertEqual(len(people), 2)
+            self.failIf([sql for sql in people if 'LIMIT' in sql])
+        finally:
+            settings.DEBUG = False
+            del settings.REPORTING_EXPORT_CHUNK_SIZE
+
+    def test_stream_reads_one_query(self):
+        klass = reporting.get_report('people')
+        settings.DEBUG, settings.REPORTING_EXPORT_CHUNK_SIZE, klass.stream = True, 2, True
+        try:
+            connection.queries = []
+            response = self.client.get('/reporting/people/', {'ds': 'y'})
+            self.assertContains(response, 'Sales')
+            people = [q['sql'] for q in connection.queries if 'FROM "people_person"' in q['sql']]
+            self.failIf([sql for sql in people if 'LIMIT' in sql])
+            groups = [sql for sql in people if 'GROUP BY "people_person"."department_id"' in sql]
+            self.assertEqual(len(groups), 1)
+        finally:
+            settings.DEBUG, klass.stream = False, False
+            del settings.REPORTING_EXPORT_CHUNK_SIZE
+
+    def test_incremental_snapshots(self):
+        class MaterializedReport(reporting.get_report('people')):
+            materialize = materialize_incremental = True
+        ReportingSite().register('people-materialized', MaterializedReport)
+        try:
+            materialize.refresh(MaterializedReport)
+            person = Person.objects.all()[0]
+            person.salary += 1000
+            person.save()
+            Person.objects.filter(lead_departments=None).exclude(pk=person.pk)[0].delete()
+        finally:
+            uid = 'reporting:incremental:people-materialized'
+            for signal in (pre_save, post_save, post_delete):
+                signal.disconnect(sender=Person, dispatch_uid=uid)
+        updated = self.snapshot_rows('people-materialized')
+        rows = dict([(row['department'], row) for row in
+                     updated[('department', materialize.filter_key([]))]])
+        self.assertEqual(rows[person.department_id]['salary'],
+                         Person.objects.filter(department=person.department).aggregate(
+                             Sum('salary'))['salary__sum'])
+        materialize.refresh(MaterializedReport)
+        self.assertEqual(updated, self.snapshot_rows('people-materialized'))
+
+    def snapshot_rows(self, slug):
+        "{(group by, filter key): sorted rows} of the snapshots of a report"
+        result = {}
+        for snapshot in ReportSnapshot.objects.filter(slug=slug):
+            rows = [materialize.loads(row.data) for row in snapshot.rows.all()]
+            rows.sort(key=lambda row: row[snapshot.group_by])
+            result[(snapshot.group_by, snapshot.filter_key)] = rows
+        return result
+
+    def test_snapshot_pages(self):
+        klass = reporting.get_report('people')
+        class MaterializedReport(klass):
+            materialize = True
+            list_per_page = 2
+        materialize.refresh(MaterializedReport)
+        for params in [{}, {'s': '2', 'st': 'desc', 'p': '1'}, {'s': '0', 'st': 'desc'},
+                       {'s': '3', 'occupation__id__exact': str(Occupation.objects.all()[0].pk)}]:
+            request = HttpRequest()
+            request.GET.update(params)
+            snapshot, direct = MaterializedReport(request, load=False), klass(request, load=False)
+            direct.list_per_page = 2
+            self.failIf(snapshot.get_snapshot() is None)
+            snapshot.load()
+            direct.load()
+            self.assertEqual(snapshot.result_count, direct.result_count)
+            self.assertEqual([(row.key, row.values) for row in snapshot.results],
+                             [(row.key, row.values) for row in direct.results])
+            self.assertEqual(snapshot.get_aggregation(), direct.get_aggregation())
+
+    def test_approximate_distinct_counts(self):
+        class ApproximateReport(reporting.get_report('people')):
+            approximate = True
+            sample_every = 1
+            annotate = (('occupation', reporting.DistinctCount),)
+            aggregate = (('occupation', reporting.DistinctCount),)
+        ReportingSite().register('people-approximate', ApproximateReport)
+        report = ApproximateReport(HttpRequest())
+        exact = dict(Person.objects.values('department').annotate(
+            n=reporting.DistinctCount('occupation')).values_list('department', 'n'))
+        self.assertEqual(dict([(row.key, row.values[1]) for row in report.results]), exact)
+        ApproximateReport.cache_timeout = 60
+        report = ApproximateReport(HttpRequest())
+        for row in report.results:
+            self.assertEqual(round(row.values[1].value), exact[row.key])
+
+
+class TimeSeriesTest(TestCase):
+    "Buckets of birth dates, quarters and weeks are combined on sqlite"
+
+    def setUp(self):
+        reporting.autodiscover()
+        class BucketReport(reporting.get_report('people')):
+            annotate = (('id', Count), ('salary', Sum), ('expenses', Avg))
+        self.klass = BucketReport
+
+    def get_rows(self, kind):
+        request = HttpRequest()
+        request.GET['gruop_by_'] = 'birth_date:%s' % kind
+        report = self.klass(request, load=False)
+        self.assertEqual(report.bucket, kind)
+        return timeseries.get_rows(report, kind)
+
+    def expected(self, kind):
+        "{bucket start: (count, salary sum, expenses sum)} computed from the people"
+        result = {}
+        for person in Person.objects.all():
+            date = timeseries.bucket_start(person.birth_date, kind)
+            count, salary, expenses = result.get(date, (0, 0, 0))
+            result[date] = (count + 1, salary + person.salary, expenses + person.expenses)
+        return result
+
+    def test_buckets(self):
+        # days a few apart share weeks, later ones months and quarters, and
+        # the last person leaves empty buckets two years before the others
+        people = list(Person.objects.order_by('pk'))
+        for ind, person in enumerate(people):
+            days = ind * 3
+            if ind >= 10:
+                days = 100 + ind * 20
+            person.birth_date = datetime.date(1980, 1, 1) + datetime.timedelta(days=days)
+            if person is people[-1]:
+                person.birth_date = datetime.date(1978, 6, 15)
+            person.save()
+        for kind in ('month', 'quarter', 'week'):
+            self.failIf(kind in timeseries.native_kinds(connection) and kind != 'month')
+            expected = self.expected(kind)
+            rows = self.get_rows(kind)
+            dates = [date for date, row in rows]
+            self.assertEqual(dates[0], min(expected))
+            self.assertEqual(dates[-1], max(expected))
+            for date, row in rows:
+                self.assertEqual(timeseries.bucket_start(date, kind), date)
+                if date not in expected:
+                    self.assertEqual((row['id'], row['salary'], row['expenses']), (0, 0, None))
+                    continue
+                count, salary, expenses = expected[date]
+                self.assertEqual((row['id'], row['salary']), (count, salary))
+                self.assertAlmostEqual(row['expenses'], float(expenses) / count)
+            for start, following in zip(dates, dates[1:]):
+                self.assertEqual(timeseries.next_bucket(start, kind), following)
+            self.failUnless(len(dates) > len(expected))
+
+
+class ReportingSiteTest(TestCase):
+    def test_entries(self):
+        site = ReportingSite()
+        site.register('declared', 'people.missing_reports.Report', 'Declared')
+        site._modules.append('people.models')
+        self.assertEqual([(slug, entry.verbose_name) for slug, entry in site.entries()],
+                         [('declared', 'Declared')])
+        self.failIf(site.get_entry('declared').loaded)
+        self.assertEqual(site._modules, [])
+
+    def test_failed_import_is_retried(self):
+        site = ReportingSite()
+        site._modules.append('people.missing_reports')
+        self.assertRaises(ImportError, site.get_entry, 'other')
+        self.assertEqual(site._modules, ['people.missing_reports'])
+
+
+class JobQueueTest(TestCase):
+    def wait(self, job):
+        while job.state in (jobs.QUEUED, jobs.RUNNING):
+            time.sleep(0.01)
+
+    def test_failed_job_is_resubmitted(self):
+        queue = jobs.JobQueue(workers=1)
+        def fail():
+            raise ValueError('failed')
+        job = queue.submit('x', fail)
+        self.wait(job)
+        self.assertEqual(job.state, jobs.FAILED)
+        self.failUnless(queue.submit('x', fail) is job)
+        retry = queue.submit('x', lambda: 1)
+        self.failIf(retry is job)
+        self.wait(retry)
+        self.assertEqual(retry.result, 1)
+        self.failUnless(queue.submit('x', fail) is retry)